@@ -0,0 +1,79 @@
+"""
+Flags sudden increases and negative values in the latest figures of each location.
+"""
+import numpy as np
+import pandas as pd
+
+
+def detect_anomalies(df, metrics, window=7, ratio=1.5, min_average=100, exclude=("International",)):
+    """
+    Compares, for every location and metric, the average of the last `window` reported
+    values with the average of the `window` values before the last one, and checks the
+    sign of the last value. Rows are expected in date order within each location.
+
+    Returns one row per location and metric with an anomaly, sorted by location and in
+    the order of metrics, with the columns location, metric, last_value, previous_average,
+    new_average, sudden_increase and negative. Locations in exclude or with no more
+    than `window` rows are not checked.
+    """
+    sizes = df.groupby("location").size()
+    df = df[df["location"].isin(sizes.index[sizes > window]) & ~df["location"].isin(exclude)]
+    codes, locations = pd.factorize(df["location"], sort=True)
+    n_metrics = len(metrics)
+
+    # Last window + 1 reported values of each (location, metric), right-aligned so
+    # that the last column holds the latest value
+    tails = np.full((len(locations) * n_metrics, window + 1), np.nan)
+    for i, metric in enumerate(metrics):
+        values = df[metric].to_numpy(dtype=np.float64, na_value=np.nan)
+        reported = ~np.isnan(values)
+        groups = codes[reported] * n_metrics + i
+        order = np.argsort(groups, kind="stable")
+        groups, values = groups[order], values[reported][order]
+        # Position of each value counted from the end of its group
+        from_end = np.searchsorted(groups, groups, side="right") - 1 - np.arange(len(groups))
+        tail = from_end <= window
+        tails[groups[tail], window - from_end[tail]] = values[tail]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        previous_average = _nanmean(tails[:, :-1])
+        new_average = _nanmean(tails[:, 1:])
+        last_value = tails[:, -1]
+        sudden_increase = (new_average >= ratio * previous_average) & (new_average > min_average)
+        negative = last_value < 0
+
+    anomalies = pd.DataFrame({
+        "location": np.repeat(np.asarray(locations, dtype=object), n_metrics),
+        "metric": np.tile(np.asarray(metrics, dtype=object), len(locations)),
+        "last_value": last_value,
+        "previous_average": previous_average,
+        "new_average": new_average,
+        "sudden_increase": sudden_increase,
+        "negative": negative,
+    })
+    return anomalies[sudden_increase | negative].reset_index(drop=True)
+
+def _nanmean(values):
+    # Same result as np.mean over the reported values only, NaN when there are none
+    return np.nansum(values, axis=1) / np.sum(~np.isnan(values), axis=1)
+
+def _format_number(value):
+    return int(value) if float(value).is_integer() else value
+
+def format_anomalies(anomalies, window=7):
+    """
+    Describes each anomaly on its own line, as posted to the data updates channel.
+    """
+    msg = ""
+    for row in anomalies.itertuples(index=False):
+        if row.sudden_increase:
+            msg += "<!> Sudden increase of *{}* in *{}*: {} ({}-day average was {})\n".format(
+                row.metric,
+                row.location,
+                int(row.last_value),
+                window,
+                int(row.previous_average)
+            )
+        if row.negative:
+            msg += f"<!> Negative number of *{row.metric}* in *{row.location}*: {_format_number(row.last_value)}\n"
+    return msg
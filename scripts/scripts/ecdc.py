@@ -1,19 +1,25 @@
+import hashlib
 import os
 import sys
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
 import pytz
 from datetime import datetime, timedelta
+from functools import lru_cache
+from pandas.api.extensions import take
 from termcolor import colored
 
 CURRENT_DIR = os.path.dirname(__file__)
 sys.path.append(CURRENT_DIR)
 
 import megafile
+from anomalies import detect_anomalies, format_anomalies
 from shared import load_population, load_owid_continents, inject_total_daily_cols, \
     inject_owid_aggregates, inject_per_million, inject_days_since, inject_cfr, inject_population, \
     inject_rolling_avg, inject_exemplars, inject_doubling_days, inject_weekly_growth, \
-    inject_biweekly_growth, standard_export, ZERO_DAY
+    inject_biweekly_growth, inject_derived_columns, standard_export, ZERO_DAY
 
 from utils.slack_client import send_warning, send_success
 from utils.db_imports import import_dataset
@@ -24,12 +30,26 @@ TMP_PATH = os.path.join(CURRENT_DIR, '../tmp')
 
 LOCATIONS_CSV_PATH = os.path.join(INPUT_PATH, 'ecdc_country_standardized.csv')
 RELEASES_PATH = os.path.join(INPUT_PATH, 'releases')
+# Parsed releases, stored as uncompressed Feather under the name and hash of the
+# release file. Only the snapshot of the current version of each release is kept.
+SNAPSHOTS_PATH = os.path.join(TMP_PATH, 'ecdc-snapshots')
 
 ERROR = colored("[Error]", 'red')
 WARNING = colored("[Warning]", 'yellow')
 
 DATASET_NAME = "COVID-2019 - ECDC (2020)"
 
+PER_MILLION_MEASURES = [
+    'new_cases',
+    'new_deaths',
+    'total_cases',
+    'total_deaths',
+    'weekly_cases',
+    'weekly_deaths',
+    'biweekly_cases',
+    'biweekly_deaths'
+]
+
 def print_err(*args, **kwargs):
     return print(*args, file=sys.stderr, **kwargs)
 
@@ -50,7 +70,7 @@ def download_csv():
         'DIR': RELEASES_PATH
     })
 
-def read_file(filename):
+def parse_file(filename):
     filepath = os.path.join(RELEASES_PATH, filename)
     if filepath.endswith("csv"):
         return pd.read_csv(
@@ -68,18 +88,56 @@ def read_file(filename):
             na_values=[""]
         )
 
+def _snapshot_path(filename):
+    digest = hashlib.sha256()
+    with open(os.path.join(RELEASES_PATH, filename), 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return os.path.join(SNAPSHOTS_PATH, '%s-%s.feather' % (os.path.basename(filename), digest.hexdigest()[:16]))
+
+def prune_snapshots(filename, snapshot_path):
+    """
+    Deletes the snapshots of earlier versions of filename, and those of releases
+    that are no longer in RELEASES_PATH.
+    """
+    if not os.path.isdir(SNAPSHOTS_PATH):
+        return
+    releases = set(os.listdir(RELEASES_PATH))
+    for snapshot_name in os.listdir(SNAPSHOTS_PATH):
+        release = snapshot_name.rsplit('-', 1)[0]
+        stale_version = release == os.path.basename(filename) and \
+            snapshot_name != os.path.basename(snapshot_path)
+        if stale_version or release not in releases:
+            os.remove(os.path.join(SNAPSHOTS_PATH, snapshot_name))
+
+def read_file(filename):
+    """
+    Reads a release, parsing it only the first time its contents are seen.
+    Later reads memory-map the snapshot stored for the same file hash.
+    """
+    snapshot_path = _snapshot_path(filename)
+    prune_snapshots(filename, snapshot_path)
+    if os.path.isfile(snapshot_path):
+        return feather.read_table(snapshot_path, memory_map=True).to_pandas()
+    df = parse_file(filename)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Columns mixing types can't be stored; such releases are parsed every time
+        return df
+    os.makedirs(SNAPSHOTS_PATH, exist_ok=True)
+    with megafile.atomic_output(snapshot_path) as tmp_path:
+        # Uncompressed so that later reads can be memory-mapped
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+    return df
+
 def load_data(filename):
     df = read_file(filename)
     # set to ints
     df['cases'] = df['cases'].astype("Int64")
     df['deaths'] = df['deaths'].astype("Int64")
     df['dateRep'] = pd.to_datetime(df['dateRep'], format="%d/%m/%Y", utc=True)
-    # fill time gaps
-    df = df.set_index(['dateRep']) \
-        .groupby('countriesAndTerritories', as_index=True) \
-        .resample('D').first() \
-        .drop(columns=['countriesAndTerritories']) \
-        .reset_index()
+    df = fill_date_gaps(df)
     df['dateRep'] = df['dateRep'].dt.date
 
     # Fix for Sweden: set recent days to np.nan when equal to 0
@@ -88,6 +146,52 @@ def load_data(filename):
     df = df[-false_rows_sweden]
     return df
 
+def fill_date_gaps(df):
+    """
+    Returns one row per country and day between the country's first and last report,
+    sorted by country and date. Days without a report are left empty, and on days
+    reported more than once each column keeps its first non-null value.
+    """
+    codes, countries = pd.factorize(df['countriesAndTerritories'], sort=True)
+    days = df['dateRep'].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+    valid = (codes >= 0) & ~np.isnat(days)
+    rows = np.flatnonzero(valid)
+    codes = codes[valid]
+    days = days[valid].astype(np.int64)
+
+    # Each country spans a contiguous block of the grid, from its first to its last day
+    first_day = np.full(len(countries), np.iinfo(np.int64).max)
+    last_day = np.full(len(countries), np.iinfo(np.int64).min)
+    np.minimum.at(first_day, codes, days)
+    np.maximum.at(last_day, codes, days)
+    lengths = np.maximum(last_day - first_day + 1, 0)
+    offsets = np.cumsum(lengths) - lengths
+    size = lengths.sum()
+    grid_codes = np.repeat(np.arange(len(countries)), lengths)
+    grid_days = np.arange(size) - offsets[grid_codes] + first_day[grid_codes]
+
+    # Grid position of every report, in order of appearance within each position
+    order = np.argsort(offsets[codes] + days - first_day[codes], kind='stable')
+    rows = rows[order]
+    positions = (offsets[codes] + days - first_day[codes])[order]
+
+    filled = {
+        'countriesAndTerritories': countries.take(grid_codes),
+        'dateRep': pd.to_datetime(grid_days, unit='D', utc=True),
+    }
+    for col in df.columns.drop(['countriesAndTerritories', 'dateRep']):
+        values = df[col].array
+        notnull = pd.notnull(values)[rows]
+        filled_positions, first = np.unique(positions[notnull], return_index=True)
+        source = np.full(size, -1)
+        source[filled_positions] = rows[notnull][first]
+        column = take(values, source, allow_fill=True)
+        # Plain integer columns come out as floats, as they did from resample()
+        if isinstance(column.dtype, np.dtype) and column.dtype.kind in 'iub':
+            column = column.astype(np.float64)
+        filled[col] = column
+    return pd.DataFrame(filled)
+
 def load_locations():
     return pd.read_csv(
         LOCATIONS_CSV_PATH,
@@ -97,7 +201,11 @@ def load_locations():
         'Our World In Data Name': 'location'
     })
 
-def _load_merged(filename):
+# The merged release is loaded once per run and shared by the checks and the
+# export. Callers get copies so they can't alter the memoized frame.
+
+@lru_cache(maxsize=None)
+def _read_merged(filename):
     df_data = load_data(filename)
     df_locs = load_locations()
     return df_data.merge(
@@ -106,6 +214,9 @@ def _load_merged(filename):
         on=['countriesAndTerritories']
     )
 
+def _load_merged(filename):
+    return _read_merged(filename).copy()
+
 def check_data_correctness(filename):
     errors = 0
 
@@ -155,33 +266,7 @@ def check_data_correctness(filename):
         )
 
     # Check for sudden changes
-    sudden_changes_msg = ''
-    for location, df_location in df_merged.groupby('location'):
-
-        # Skip checks for "International"
-        if location == 'International' or df_location.shape[0] < 8:
-            continue
-
-        for var_name in ['cases', 'deaths']:
-            country_vals = df_location[var_name].dropna().values
-            if len(country_vals) == 0:
-                continue
-
-            previous_RA = np.mean(country_vals[-8:-1])
-            new_RA = np.mean(country_vals[-7:])
-
-            if new_RA >= 1.5 * previous_RA and new_RA > 100:
-                sudden_changes_msg += "<!> Sudden increase of *{}* in *{}*: {} (7-day average was {})\n".format(
-                    var_name,
-                    location,
-                    int(country_vals[-1]),
-                    int(previous_RA)
-                )
-
-            new_val = country_vals[-1]
-
-            if new_val < 0:
-                sudden_changes_msg += f"<!> Negative number of *{var_name}* in *{location}*: {new_val}\n"
+    sudden_changes_msg = format_anomalies(detect_anomalies(df_merged, ['cases', 'deaths']))
 
     if sudden_changes_msg:
         print(sudden_changes_msg)
@@ -209,7 +294,7 @@ def discard_rows(df):
 
 # Must output columns:
 # date, location, new_cases, new_deaths, total_cases, total_deaths
-def load_standardized(filename):
+def load_standardized(filename, fused=True):
     df = _load_merged(filename) \
         .drop(columns=[
             'countriesAndTerritories', 'geoId',
@@ -224,19 +309,13 @@ def load_standardized(filename):
     df = inject_owid_aggregates(df)
     df = discard_rows(df)
     df = inject_total_daily_cols(df, ['cases', 'deaths'])
+    if fused:
+        return inject_derived_columns(df, PER_MILLION_MEASURES)
+    # Step-by-step reference path, much slower but useful to check the fused one against
     df = inject_weekly_growth(df)
     df = inject_biweekly_growth(df)
     df = inject_doubling_days(df)
-    df = inject_per_million(df, [
-        'new_cases',
-        'new_deaths',
-        'total_cases',
-        'total_deaths',
-        'weekly_cases',
-        'weekly_deaths',
-        'biweekly_cases',
-        'biweekly_deaths'
-    ])
+    df = inject_per_million(df, PER_MILLION_MEASURES)
     df = inject_rolling_avg(df)
     df = inject_cfr(df)
     df = inject_days_since(df)
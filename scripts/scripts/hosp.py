@@ -1,8 +1,11 @@
+import argparse
 import datetime
 import json
 import os
 import requests
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -17,6 +20,8 @@ from utils.db_imports import import_dataset
 
 SOURCE_URL = "https://opendata.ecdc.europa.eu/covid19/hospitalicuadmissionrates/csv/data.csv"
 INPUT_PATH = os.path.join(CURRENT_DIR, "../input/")
+# Raw responses of the last download, from which the dataset can be rebuilt offline
+RAW_PATH = os.path.join(CURRENT_DIR, "../tmp/hosp/")
 GRAPHER_PATH = os.path.join(CURRENT_DIR, "../grapher/")
 DATASET_NAME = "COVID-2019 - Hospital & ICU"
 ZERO_DAY = "2020-01-21"
@@ -26,9 +31,97 @@ POPULATION = pd.read_csv(
 )
 
 
-def download_data():
-    print("Downloading ECDC data…")
-    df = pd.read_csv(SOURCE_URL, usecols=["country", "indicator", "date", "value", "year_week"])
+# Sources are fetched concurrently. timeout is the time in seconds allowed for
+# each attempt to download the whole response.
+SOURCES = {
+    "ecdc": {
+        "url": SOURCE_URL,
+        "file": "ecdc.csv",
+        "timeout": 120,
+    },
+    "united_states": {
+        "url": "https://healthdata.gov/api/views/g62h-syeh/rows.csv",
+        "file": "united_states.csv",
+        "timeout": 300,
+    },
+    "canada": {
+        "url": "https://api.covid19tracker.ca/reports?after=2020-03-09",
+        "file": "canada.json",
+        "timeout": 60,
+    },
+    "uk": {
+        "url": "https://api.coronavirus.data.gov.uk/v2/data?areaType=overview&metric=hospitalCases&metric=newAdmissions&metric=covidOccupiedMVBeds&format=csv",
+        "file": "uk.csv",
+        "timeout": 60,
+    },
+    "israel": {
+        "url": "https://datadashboardapi.health.gov.il/api/queries/patientsPerDate",
+        "file": "israel.json",
+        "timeout": 60,
+    },
+}
+RETRIES = 3
+
+
+def raw_path(name):
+    return os.path.join(RAW_PATH, SOURCES[name]["file"])
+
+
+def fetch_source(name, retries=RETRIES):
+    """
+    Downloads a source to its raw file, retrying with exponential backoff when an
+    attempt fails or doesn't complete within the source's timeout.
+    """
+    source = SOURCES[name]
+    path = raw_path(name)
+    tmp_path = path + ".tmp"
+    for attempt in range(retries + 1):
+        try:
+            deadline = time.monotonic() + source["timeout"]
+            with requests.get(source["url"], stream=True, timeout=source["timeout"]) as response:
+                response.raise_for_status()
+                with open(tmp_path, "wb") as file:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        if time.monotonic() > deadline:
+                            raise requests.Timeout(f"Download took more than {source['timeout']}s")
+                        file.write(chunk)
+            os.replace(tmp_path, path)
+            print(f"Downloaded {name} data")
+            return path
+        except requests.RequestException as e:
+            if attempt == retries:
+                raise
+            print(f"Retrying {name} download ({e})")
+            time.sleep(2 ** attempt)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def prune_raw_files():
+    """
+    Removes the files in RAW_PATH that don't belong to a current source, such as those
+    of dropped sources or partial downloads left by an interrupted run.
+    """
+    files = {source["file"] for source in SOURCES.values()}
+    for file_name in os.listdir(RAW_PATH):
+        if file_name not in files:
+            os.remove(os.path.join(RAW_PATH, file_name))
+
+
+def fetch_sources():
+    """
+    Downloads every source concurrently, keeping the raw responses in RAW_PATH.
+    """
+    os.makedirs(RAW_PATH, exist_ok=True)
+    prune_raw_files()
+    with ThreadPoolExecutor(max_workers=len(SOURCES)) as executor:
+        # Iterating the results raises the first download error, if any
+        list(executor.map(fetch_source, SOURCES))
+
+
+def load_data():
+    df = pd.read_csv(raw_path("ecdc"), usecols=["country", "indicator", "date", "value", "year_week"])
     df = df.drop_duplicates()
     df = df.rename(columns={"country": "entity"})
     return df
@@ -59,11 +152,8 @@ def week_to_date(df):
     return df
 
 
-def add_united_states(df):
-    print("Downloading US data…")
-    url = "https://healthdata.gov/api/views/g62h-syeh/rows.csv"
-
-    usa = pd.read_csv(url, usecols=[
+def get_united_states():
+    usa = pd.read_csv(raw_path("united_states"), usecols=[
         "date",
         "total_adult_patients_hospitalized_confirmed_covid",
         "total_pediatric_patients_hospitalized_confirmed_covid",
@@ -116,15 +206,12 @@ def add_united_states(df):
     usa.loc[:, "entity"] = "United States"
     usa.loc[:, "iso_code"] = "USA"
     usa.loc[:, "population"] = 331002647
-
-    df = pd.concat([df, usa])
-    return df
+    return usa
 
 
-def add_canada(df):
-    print("Downloading Canada data…")
-    url = "https://api.covid19tracker.ca/reports?after=2020-03-09"
-    data = requests.get(url).json()
+def get_canada():
+    with open(raw_path("canada")) as file:
+        data = json.load(file)
     data = json.dumps(data["data"])
     canada = pd.read_json(data, orient="records")
     canada = canada[["date", "total_hospitalizations", "total_criticals"]]
@@ -138,15 +225,11 @@ def add_canada(df):
     canada.loc[:, "entity"] = "Canada"
     canada.loc[:, "iso_code"] = "CAN"
     canada.loc[:, "population"] = 37742157
-
-    df = pd.concat([df, canada])
-    return df
+    return canada
 
 
-def add_uk(df):
-    print("Downloading UK data…")
-    url = "https://api.coronavirus.data.gov.uk/v2/data?areaType=overview&metric=hospitalCases&metric=newAdmissions&metric=covidOccupiedMVBeds&format=csv"
-    uk = pd.read_csv(url, usecols=["date", "hospitalCases", "newAdmissions", "covidOccupiedMVBeds"])
+def get_uk():
+    uk = pd.read_csv(raw_path("uk"), usecols=["date", "hospitalCases", "newAdmissions", "covidOccupiedMVBeds"])
     uk.loc[:, "date"] = pd.to_datetime(uk["date"])
 
     stock = uk[["date", "hospitalCases", "covidOccupiedMVBeds"]].copy()
@@ -169,15 +252,11 @@ def add_uk(df):
     uk.loc[:, "entity"] = "United Kingdom"
     uk.loc[:, "iso_code"] = "GBR"
     uk.loc[:, "population"] = 67886004
-
-    df = pd.concat([df, uk])
-    return df
+    return uk
 
 
-def add_israel(df):
-    print("Downloading Israel data…")
-    url = "https://datadashboardapi.health.gov.il/api/queries/patientsPerDate"
-    israel = pd.read_json(url)
+def get_israel():
+    israel = pd.read_json(raw_path("israel"))
     israel.loc[:, "date"] = pd.to_datetime(israel["date"])
 
     stock = israel[["date", "Counthospitalized", "CountCriticalStatus"]].copy()
@@ -202,17 +281,17 @@ def add_israel(df):
     israel.loc[:, "entity"] = "Israel"
     israel.loc[:, "iso_code"] = "ISR"
     israel.loc[:, "population"] = 8655541
-
-    return pd.concat([df, israel])
-
+    return israel
 
 
 def add_countries(df):
-    df = add_united_states(df)
-    df = add_canada(df)
-    df = add_uk(df)
-    df = add_israel(df)
-    return df
+    # The country transforms only read their own raw file, so they run side by side
+    with ThreadPoolExecutor() as executor:
+        countries = [
+            executor.submit(get_country)
+            for get_country in [get_united_states, get_canada, get_uk, get_israel]
+        ]
+        return pd.concat([df, *(country.result() for country in countries)])
 
 
 def add_per_million(df):
@@ -242,8 +321,11 @@ def date_to_owid_year(df):
     return df
 
 
-def generate_dataset():
-    df = download_data()
+def generate_dataset(skip_download=False):
+    if not skip_download:
+        print("Downloading source data…")
+        fetch_sources()
+    df = load_data()
     df = standardize_entities(df)
     df = undo_per_100k(df)
     df = week_to_date(df)
@@ -271,4 +353,7 @@ def update_db():
 
 
 if __name__ == "__main__":
-    generate_dataset()
+    parser = argparse.ArgumentParser(description="Generate the hospital & ICU dataset")
+    parser.add_argument("-s", "--skip-download", action="store_true", help="Rebuild from the raw files of the last download")
+    args = parser.parse_args()
+    generate_dataset(skip_download=args.skip_download)
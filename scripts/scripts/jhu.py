@@ -1,9 +1,13 @@
 import argparse
+import hashlib
+import json
 import os
 import sys
 from functools import reduce
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
 import pytz
 from datetime import datetime, timedelta
 from termcolor import colored
@@ -12,10 +16,12 @@ CURRENT_DIR = os.path.dirname(__file__)
 sys.path.append(CURRENT_DIR)
 
 import megafile
+from anomalies import detect_anomalies, format_anomalies
 from shared import load_population, load_owid_continents, inject_total_daily_cols, \
     inject_owid_aggregates, inject_per_million, inject_days_since, inject_cfr, inject_population, \
     inject_rolling_avg, inject_exemplars, inject_doubling_days, inject_weekly_growth, \
-    inject_biweekly_growth, standard_export, ZERO_DAY
+    inject_biweekly_growth, inject_derived_columns, standard_export, standard_table, ZERO_DAY, \
+    POPULATION_CSV_PATH
 
 from utils.slack_client import send_warning, send_success
 from utils.db_imports import import_dataset
@@ -25,12 +31,27 @@ OUTPUT_PATH = os.path.join(CURRENT_DIR, "../../public/data/jhu/")
 TMP_PATH = os.path.join(CURRENT_DIR, "../tmp")
 
 LOCATIONS_CSV_PATH = os.path.join(INPUT_PATH, "jhu_country_standardized.csv")
+# Standardized output of the last run, used to only recompute what changed since.
+# It is stored with the key of the inputs it was derived from besides the JHU data.
+STANDARDIZED_CACHE_PATH = os.path.join(TMP_PATH, "jhu_standardized.feather")
+STANDARDIZED_CACHE_KEY = b"owid_cache_key"
 
 ERROR = colored("[Error]", "red")
 WARNING = colored("[Warning]", "yellow")
 
 DATASET_NAME = "COVID-19 - Johns Hopkins University"
 
+PER_MILLION_MEASURES = [
+    "new_cases",
+    "new_deaths",
+    "total_cases",
+    "total_deaths",
+    "weekly_cases",
+    "weekly_deaths",
+    "biweekly_cases",
+    "biweekly_deaths"
+]
+
 def print_err(*args, **kwargs):
     return print(*args, file=sys.stderr, **kwargs)
 
@@ -44,14 +65,11 @@ def download_csv():
         os.system(f"curl --silent -f -o {INPUT_PATH}/{file} -L https://github.com/CSSEGISandData/COVID-19/raw/master/csse_covid_19_data/csse_covid_19_time_series/{file}")
 
 def get_metric(metric, region):
+    """Returns the national series of a metric as a country × date frame."""
     file_path = os.path.join(INPUT_PATH, f"time_series_covid19_{metric}_{region}.csv")
     df = pd.read_csv(file_path).drop(columns=["Lat", "Long"])
-    
-    if metric == "confirmed":
-        metric = "total_cases"
-    elif metric == "deaths":
-        metric = "total_deaths"
-    else:
+
+    if metric not in ("confirmed", "deaths"):
         print_err("Unknown metric requested.\n")
         sys.exit(1)
 
@@ -63,34 +81,63 @@ def get_metric(metric, region):
     # subnational.loc[:, "Country/Region"] = subnational["Country/Region"] + " – " + subnational["Province/State"]
     # subnational = subnational.drop(columns=["Province/State"])
 
-    national = df.drop(columns="Province/State").groupby("Country/Region", as_index=False).sum()
-
-    df = national.copy() # df = pd.concat([national, subnational]).reset_index(drop=True)
-    df = df.melt(
-        id_vars="Country/Region",
-        var_name="date",
-        value_name=metric
-    )
-    df.loc[:, "date"] = pd.to_datetime(df["date"], format="%m/%d/%y").dt.date
-    df = df.sort_values("date")
+    national = df.drop(columns="Province/State").groupby("Country/Region").sum()
+    national.columns = pd.to_datetime(national.columns, format="%m/%d/%y")
+    return national
 
+def _total_and_new(national, countries, dates):
+    """
+    Returns the total and new values of a country × date frame on the given grid,
+    along with a mask of the cells to keep.
+    """
+    totals = national.to_numpy(dtype=float)
     # Only start country series when total_cases > 0 or total_deaths > 0 to minimize file size
-    cutoff = (
-        df.loc[df[metric] == 0, ["date", "Country/Region"]]
-        .groupby("Country/Region", as_index=False)
-        .max()
-        .rename(columns={"date": "cutoff"})
-    )
-    df = df.merge(cutoff, on="Country/Region", how="left")
-    df = df[(df.date >= df.cutoff) | (df.cutoff.isna())].drop(columns="cutoff")
-
-    df.loc[:, metric.replace("total_", "new_")] = df[metric] - df.groupby("Country/Region")[metric].shift(1)
-    return df
+    date_positions = np.arange(totals.shape[1])
+    cutoff = np.where(totals == 0, date_positions, -1).max(axis=1)
+    kept = date_positions >= cutoff[:, np.newaxis]
+
+    new = np.full(totals.shape, np.nan)
+    new[:, 1:] = totals[:, 1:] - totals[:, :-1]
+    new[~np.roll(kept, 1, axis=1) | (date_positions == 0)] = np.nan
+
+    # Place the kept cells on the shared grid, leaving the rest missing
+    cells = np.ix_(countries.get_indexer(national.index), dates.get_indexer(national.columns))
+    grid_total = np.full((len(countries), len(dates)), np.nan)
+    grid_new = np.full((len(countries), len(dates)), np.nan)
+    grid_kept = np.zeros((len(countries), len(dates)), dtype=bool)
+    grid_total[cells] = np.where(kept, totals, np.nan)
+    grid_new[cells] = np.where(kept, new, np.nan)
+    grid_kept[cells] = kept
+    return grid_total, grid_new, grid_kept
 
 def load_data():
-    global_cases = get_metric("confirmed", "global")
-    global_deaths = get_metric("deaths", "global")
-    return pd.merge(global_cases, global_deaths, on=["date", "Country/Region"], how="outer")
+    nationals = {
+        "cases": get_metric("confirmed", "global"),
+        "deaths": get_metric("deaths", "global")
+    }
+    countries = reduce(pd.Index.union, [national.index for national in nationals.values()])
+    dates = reduce(pd.Index.union, [national.columns for national in nationals.values()])
+
+    columns = {}
+    kept = np.zeros((len(countries), len(dates)), dtype=bool)
+    for metric, national in nationals.items():
+        total, new, metric_kept = _total_and_new(national, countries, dates)
+        columns[metric] = (total, new, metric_kept, national.dtypes)
+        kept |= metric_kept
+
+    # Rows are ordered by date, then country
+    date_idx, country_idx = np.nonzero(kept.T)
+    df = pd.DataFrame({
+        "Country/Region": countries.to_numpy()[country_idx],
+        "date": dates.date[date_idx]
+    })
+    for metric, (total, new, metric_kept, dtypes) in columns.items():
+        total = total[country_idx, date_idx]
+        if metric_kept[country_idx, date_idx].all() and all(np.issubdtype(dtype, np.integer) for dtype in dtypes):
+            total = total.astype(np.int64)
+        df[f"total_{metric}"] = total
+        df[f"new_{metric}"] = new[country_idx, date_idx]
+    return df
 
 def load_locations():
     return pd.read_csv(
@@ -144,6 +191,18 @@ def check_data_correctness(df_merged):
             message=formatted_msg
         )
 
+    # Check for sudden changes
+    sudden_changes_msg = format_anomalies(detect_anomalies(df_merged, ["new_cases", "new_deaths"]))
+
+    if sudden_changes_msg:
+        print(sudden_changes_msg)
+        formatted_msg = sudden_changes_msg.replace("<!>", ":warning:")
+        send_warning(
+            channel="corona-data-updates",
+            title="Sudden changes in data",
+            message=formatted_msg
+        )
+
     return errors == 0
 
 def discard_rows(df):
@@ -154,30 +213,63 @@ def discard_rows(df):
     ] = np.nan
     return df
 
-def load_standardized(df):
+def load_standardized(df, fused=True, previous=None):
     df = df[["date", "location", "new_cases", "new_deaths", "total_cases", "total_deaths"]]
     df = discard_rows(df)
     df = inject_owid_aggregates(df)
+    if fused:
+        return inject_derived_columns(df, PER_MILLION_MEASURES, previous=previous)
+    # Step-by-step reference path, much slower but useful to check the fused one against
     df = inject_weekly_growth(df)
     df = inject_biweekly_growth(df)
     df = inject_doubling_days(df)
-    df = inject_per_million(df, [
-        "new_cases",
-        "new_deaths",
-        "total_cases",
-        "total_deaths",
-        "weekly_cases",
-        "weekly_deaths",
-        "biweekly_cases",
-        "biweekly_deaths"
-    ])
+    df = inject_per_million(df, PER_MILLION_MEASURES)
     df = inject_rolling_avg(df)
     df = inject_cfr(df)
     df = inject_days_since(df)
     df = inject_exemplars(df)
     return df.sort_values(by=["location", "date"])
 
-def export(df_merged):
+def _standardized_cache_key():
+    # Per-million columns and their rolling averages depend on the population
+    # figures and on the list of measures they are computed for
+    digest = hashlib.sha256()
+    with open(POPULATION_CSV_PATH, "rb") as file:
+        digest.update(file.read())
+    digest.update(json.dumps(PER_MILLION_MEASURES).encode())
+    return digest.hexdigest().encode()
+
+def load_previous_standardized():
+    if not os.path.isfile(STANDARDIZED_CACHE_PATH):
+        return None
+    table = feather.read_table(STANDARDIZED_CACHE_PATH)
+    if (table.schema.metadata or {}).get(STANDARDIZED_CACHE_KEY) != _standardized_cache_key():
+        print("Population figures or per million measures changed since the last run, recomputing the whole history")
+        return None
+    return table.to_pandas()
+
+def save_standardized(df):
+    os.makedirs(TMP_PATH, exist_ok=True)
+    table = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        STANDARDIZED_CACHE_KEY: _standardized_cache_key(),
+    })
+    with megafile.atomic_output(STANDARDIZED_CACHE_PATH) as tmp_path:
+        feather.write_feather(table, tmp_path)
+
+def save_megafile_input(df):
+    """
+    Writes the long-format JHU variables read by the megafile, and returns them.
+    """
+    df = standard_table(df)[["location", "date", *megafile.JHU_VARIABLES]].reset_index(drop=True)
+    df["date"] = df["date"].astype(str)
+    os.makedirs(TMP_PATH, exist_ok=True)
+    with megafile.atomic_output(megafile.JHU_CACHE_PATH) as tmp_path:
+        df.to_feather(tmp_path)
+    return df
+
+def export(df_merged, full=False):
     df_loc = df_merged[["Country/Region", "location"]].drop_duplicates()
     df_loc = df_loc.merge(
         load_owid_continents(),
@@ -190,13 +282,14 @@ def export(df_merged):
     df_loc = df_loc.sort_values("location")
     df_loc.to_csv(os.path.join(OUTPUT_PATH, "locations.csv"), index=False)
     # The rest of the CSVs
-    return standard_export(
-        load_standardized(df_merged),
-        OUTPUT_PATH,
-        DATASET_NAME
-    )
+    previous = None if full else load_previous_standardized()
+    df = load_standardized(df_merged, previous=previous)
+    if not standard_export(df, OUTPUT_PATH, DATASET_NAME):
+        return None
+    save_standardized(df)
+    return save_megafile_input(df)
 
-def main(skip_download=False):
+def main(skip_download=False, full=False):
 
     if not skip_download:
         print("\nAttempting to download latest CSV files...")
@@ -210,14 +303,15 @@ def main(skip_download=False):
         print_err("Data correctness check %s.\n" % colored("failed", "red"))
         sys.exit(1)
 
-    if export(df_merged):
+    jhu_long = export(df_merged, full=full)
+    if jhu_long is not None:
         print("Successfully exported CSVs to %s\n" % colored(os.path.abspath(OUTPUT_PATH), "magenta"))
     else:
         print_err("JHU export failed.\n")
         sys.exit(1)
 
     print("Generating megafile…")
-    megafile.generate_megafile()
+    megafile.generate_megafile(jhu_long)
     print("Megafile is ready.")
 
     send_success(
@@ -242,5 +336,6 @@ def update_db():
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run JHU update script")
     parser.add_argument("-s", "--skip-download", action="store_true", help="Skip downloading files from the JHU repository")
+    parser.add_argument("-f", "--full", action="store_true", help="Recompute the whole history instead of only the dates that changed since the last run (needed after changing population figures)")
     args = parser.parse_args()
-    main(skip_download=args.skip_download)
+    main(skip_download=args.skip_download, full=args.full)
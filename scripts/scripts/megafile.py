@@ -1,16 +1,31 @@
 """
 Merges the main COVID-19 testing dataset with each of the COVID-19 JHU datasets into a 'megafile';
 - Follows a long format of 1 row per country & date, and variables as columns;
-- Published in CSV, XLSX, and JSON formats;
+- Published in CSV, XLSX, JSON, Parquet and Feather formats;
 - Includes derived variables that can't be easily calculated, such as X per capita;
 - Includes country ISO codes in a column next to country names.
 """
 
+import hashlib
+import inspect
+import io
 import json
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
-from functools import reduce
+from functools import lru_cache
+import numpy as np
 import pandas as pd
+import requests
+import xlsxwriter
+from pandas.api.extensions import take
+from pandas.api.types import is_categorical_dtype, is_datetime64_dtype, is_extension_array_dtype, \
+    is_integer_dtype
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 
 
 CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -18,53 +33,122 @@ INPUT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "../input/"))
 GRAPHER_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "../grapher/"))
 DATA_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "../../public/data/"))
 
+# Normalized source frames, stored under the hash of their inputs
+SOURCE_CACHE_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "../tmp/megafile/"))
 
-def get_jhu():
+REPROD_URL = "https://github.com/crondonm/TrackingR/raw/main/Estimates-Database/database.csv"
+REPROD_MAPPING_PATH = os.path.join(INPUT_DIR, "reproduction/reprod_country_standardized.csv")
+# Local mirror of the filtered reproduction rates, refreshed with conditional requests
+REPROD_MIRROR_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "../tmp/reproduction/"))
+
+# Entity columns held as categoricals in memory
+CATEGORY_COLUMNS = ["iso_code", "continent", "location", "tests_units"]
+
+# Columns stored dictionary-encoded in the Parquet and Feather outputs
+ARROW_DICTIONARY_COLUMNS = ["iso_code", "continent", "location"]
+
+
+JHU_VARIABLES = [
+    "total_cases",
+    "new_cases",
+    "weekly_cases",
+    "total_deaths",
+    "new_deaths",
+    "weekly_deaths",
+    "total_cases_per_million",
+    "new_cases_per_million",
+    "weekly_cases_per_million",
+    "total_deaths_per_million",
+    "new_deaths_per_million",
+    "weekly_deaths_per_million"
+]
+
+# Long-format copy of the JHU variables, written by jhu.py along with its CSV exports
+JHU_CACHE_PATH = os.path.abspath(os.path.join(CURRENT_DIR, "../tmp/jhu_megafile.feather"))
+
+
+def read_jhu_cache():
+    """
+    Reads the long-format JHU cache, unless it is missing or older than the JHU CSV exports.
     """
-    Reads each COVID-19 JHU dataset located in /public/data/jhu/
-    Melts the dataframe to vertical format (1 row per country and date)
-    Merges all JHU dataframes into one with outer joins
+    csv_path = os.path.join(DATA_DIR, "jhu/total_cases.csv")
+    if not os.path.isfile(JHU_CACHE_PATH):
+        return None
+    if os.path.isfile(csv_path) and os.path.getmtime(JHU_CACHE_PATH) < os.path.getmtime(csv_path):
+        print("JHU cache is older than the JHU CSV files, ignoring it")
+        return None
+    return pd.read_feather(JHU_CACHE_PATH)
 
-    Returns:
-        jhu {dataframe}
+
+def _read_jhu_csv(jhu_var):
+    """
+    Reads the wide CSV file of a JHU variable and melts it to vertical format.
     """
+    tmp = pd.read_csv(os.path.join(DATA_DIR, f"../../public/data/jhu/{jhu_var}.csv"))
+    country_cols = list(tmp.columns)
+    country_cols.remove("date")
+
+    # Carrying last observation forward for International totals to avoid discrepancies
+    if jhu_var[:5] == "total":
+        tmp = tmp.sort_values("date")
+        tmp["International"] = tmp["International"].ffill()
+
+    return (
+        pd.melt(tmp, id_vars="date", value_vars=country_cols)
+        .rename(columns={"value": jhu_var, "variable": "location"})
+        .dropna()
+    )
 
-    jhu_variables = [
-        "total_cases",
-        "new_cases",
-        "weekly_cases",
-        "total_deaths",
-        "new_deaths",
-        "weekly_deaths",
-        "total_cases_per_million",
-        "new_cases_per_million",
-        "weekly_cases_per_million",
-        "total_deaths_per_million",
-        "new_deaths_per_million",
-        "weekly_deaths_per_million"
-    ]
 
-    data_frames = []
+def _select_jhu_long(jhu_long, jhu_var, dates):
+    """
+    Returns the non-missing values of a JHU variable from the long-format frame,
+    in vertical format like _read_jhu_csv.
+    """
+    tmp = jhu_long.loc[jhu_long[jhu_var].notnull(), ["date", "location", jhu_var]]
+
+    # Carrying last observation forward for International totals to avoid discrepancies,
+    # over all dates of the dataset as the wide files do
+    if jhu_var[:5] == "total":
+        international = tmp[tmp["location"] == "International"].set_index("date")[jhu_var]
+        international = international.reindex(dates).ffill().dropna()
+        tmp = pd.concat([
+            tmp[tmp["location"] != "International"],
+            pd.DataFrame({
+                "date": international.index,
+                "location": "International",
+                jhu_var: international.to_numpy()
+            })
+        ])
+    return tmp.reset_index(drop=True)
+
+
+def get_jhu(jhu_long=None):
+    """
+    Returns the COVID-19 JHU variables in vertical format (1 row per country and date)
+    Uses, in order of preference:
+    - the long-format frame handed over by jhu.py, with location, date and JHU_VARIABLES;
+    - the long-format cache jhu.py writes to JHU_CACHE_PATH;
+    - each COVID-19 JHU dataset located in /public/data/jhu/, melted to vertical format
+    All variables are joined into one with an outer join
 
-    # Process each file and melt it to vertical format
-    for jhu_var in jhu_variables:
-        tmp = pd.read_csv(os.path.join(DATA_DIR, f"../../public/data/jhu/{jhu_var}.csv"))
-        country_cols = list(tmp.columns)
-        country_cols.remove("date")
+    Returns:
+        jhu {dataframe}
+    """
 
-        # Carrying last observation forward for International totals to avoid discrepancies
-        if jhu_var[:5] == "total":
-            tmp = tmp.sort_values("date")
-            tmp["International"] = tmp["International"].ffill()
+    if jhu_long is None:
+        jhu_long = read_jhu_cache()
 
-        tmp = (
-            pd.melt(tmp, id_vars="date", value_vars=country_cols)
-            .rename(columns={"value": jhu_var, "variable": "location"})
-            .dropna()
-        )
+    if jhu_long is not None:
+        dates = np.sort(jhu_long["date"].unique())
+        data_frames = [_select_jhu_long(jhu_long, jhu_var, dates) for jhu_var in JHU_VARIABLES]
+    else:
+        data_frames = [_read_jhu_csv(jhu_var) for jhu_var in JHU_VARIABLES]
+
+    for tmp, jhu_var in zip(data_frames, JHU_VARIABLES):
         if jhu_var[:7] == "weekly_":
             tmp[jhu_var] = tmp[jhu_var].div(7).round(3)
-            tmp = tmp.rename(errors="ignore", columns={
+            tmp.rename(inplace=True, errors="ignore", columns={
                 "weekly_cases": "new_cases_smoothed",
                 "weekly_deaths": "new_deaths_smoothed",
                 "weekly_cases_per_million": "new_cases_smoothed_per_million",
@@ -72,21 +156,17 @@ def get_jhu():
             })
         else:
             tmp[jhu_var] = tmp[jhu_var].round(3)
-        data_frames.append(tmp)
     print()
 
-    # Outer join between all files
-    jhu = reduce(
-        lambda left, right: pd.merge(left, right, on=["date", "location"], how="outer"),
-        data_frames
-    )
+    # Outer join between all variables
+    jhu = join_on_location_date([(df, "outer") for df in data_frames])
 
     return jhu
 
 
-def get_reprod():
+def _normalize_reprod(csv_file, mapping_path):
     reprod = pd.read_csv(
-        "https://github.com/crondonm/TrackingR/raw/main/Estimates-Database/database.csv",
+        csv_file,
         usecols=["Country/Region", "Date", "R", "days_infectious"]
     )
     reprod = (
@@ -99,8 +179,66 @@ def get_reprod():
         })
         .round(2)
     )
-    mapping = pd.read_csv(os.path.join(INPUT_DIR, "reproduction/reprod_country_standardized.csv"))
+    mapping = pd.read_csv(mapping_path)
     reprod = reprod.replace(dict(zip(mapping.reprod, mapping.owid)))
+    return reprod.reset_index(drop=True)
+
+
+def get_reprod(url=REPROD_URL, mirror_dir=REPROD_MIRROR_DIR, mapping_path=REPROD_MAPPING_PATH):
+    """
+    Returns the reproduction rates, refreshing the local mirror in mirror_dir from url.
+
+    The mirror holds the filtered rates, renamed with the country mapping in mapping_path,
+    as Feather along with the ETag and Last-Modified headers of the download, so an
+    unchanged upstream file only costs a 304 response. If url can't be reached, the
+    mirror is used as is.
+    """
+    data_path = os.path.join(mirror_dir, "reprod.feather")
+    meta_path = os.path.join(mirror_dir, "reprod_mirror.json")
+
+    meta = {}
+    if os.path.isfile(data_path) and os.path.isfile(meta_path):
+        with open(meta_path) as file:
+            meta = json.load(file)
+    # The mirror is only valid for the URL and country mapping it was built from
+    mapping_digest = _file_digest(mapping_path)
+    if meta.get("url") != url or meta.get("mapping") != mapping_digest:
+        meta = {}
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        response = requests.get(url, headers=headers, timeout=60)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        if not meta:
+            raise
+        print(f"<!> Could not refresh the reproduction rates ({e}), using the local mirror")
+        return pd.read_feather(data_path)
+
+    if response.status_code == 304:
+        print("[mirror hit] reprod")
+        source_cache_stats["hits"].append("reprod")
+        return pd.read_feather(data_path)
+
+    print("[mirror miss] reprod")
+    source_cache_stats["misses"].append("reprod")
+    reprod = _normalize_reprod(io.BytesIO(response.content), mapping_path)
+    os.makedirs(mirror_dir, exist_ok=True)
+    with atomic_output(data_path) as tmp_path:
+        reprod.to_feather(tmp_path, compression="zstd")
+    with atomic_output(meta_path) as tmp_path:
+        with open(tmp_path, "w") as file:
+            json.dump({
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "mapping": mapping_digest,
+            }, file, indent=2)
     return reprod
 
 
@@ -220,6 +358,109 @@ def get_testing():
     return testing
 
 
+@lru_cache(maxsize=None)
+def get_testing_locations():
+    """
+    Returns the set of locations that have testing data, without loading the full testing dataset.
+    Only the Entity column is read, and the result is cached for the rest of the process.
+    """
+    entities = pd.read_csv(
+        os.path.join(DATA_DIR, "testing/covid-testing-all-observations.csv"),
+        usecols=["Entity"]
+    )["Entity"].unique()
+    to_remove = pd.read_csv(os.path.join(INPUT_DIR, "owid/secondary_testing_series.csv"))
+    secondary = set(f"{loc} - {unit}" for loc, unit in to_remove.itertuples(index=False, name=None))
+    return frozenset(entity.split(" - ")[0] for entity in entities if entity not in secondary)
+
+
+def _day_ordinals(dates):
+    """
+    Converts YYYY-MM-DD date strings to the number of days since the epoch.
+    Each distinct date is only parsed once.
+    """
+    codes, uniques = pd.factorize(dates)
+    days = pd.to_datetime(uniques, format="%Y-%m-%d").to_numpy().astype("datetime64[D]").astype(np.int64)
+    return days[codes]
+
+def _scatter(values, positions, n):
+    """
+    Places values at the given positions of a column of length n, leaving the rest
+    missing. Integer columns stay integers when no value is missing, like with merge,
+    and other dtypes (e.g. float32, categorical or nullable integers) are kept.
+    """
+    indexer = np.full(n, -1)
+    indexer[positions] = np.arange(len(positions))
+    return take(values, indexer, allow_fill=True)
+
+def join_on_location_date(sources):
+    """
+    Joins dataframes keyed on location and date in a single step, instead of chaining
+    pairwise merges.
+
+    Locations are interned as integer codes and dates as day ordinals, so each
+    (location, date) pair is a single integer key. Sources are (dataframe, how) pairs,
+    applied in order like a chain of merges: an "outer" source adds its keys to the
+    result, while a "left" source only fills in keys added by the sources before it.
+
+    Returns a dataframe with location (categorical), date (datetime) and then the
+    value columns of each source, sorted by location and date.
+    """
+    locations = pd.Index(pd.unique(np.concatenate([
+        df["location"].to_numpy(dtype=object) for df, _ in sources
+    ]))).sort_values()
+    codes = [locations.get_indexer(df["location"]) for df, _ in sources]
+    days = [_day_ordinals(df["date"]) for df, _ in sources]
+    min_day = min(source_days.min() for source_days in days)
+    n_days = max(source_days.max() for source_days in days) - min_day + 1
+
+    keys = np.array([], dtype=np.int64)
+    source_rows = []
+    for (df, how), source_codes, source_days in zip(sources, codes, days):
+        source_keys = source_codes * n_days + (source_days - min_day)
+        if pd.Index(source_keys).has_duplicates:
+            raise Exception("Multiple rows for the same location and date")
+        if how == "outer":
+            keys = np.union1d(keys, source_keys)
+            rows = np.arange(len(df))
+        elif how == "left":
+            rows = np.flatnonzero(np.isin(source_keys, keys))
+        else:
+            raise ValueError(f"Unknown join type: {how}")
+        source_rows.append((source_keys[rows], rows))
+
+    joined = {
+        "location": pd.Categorical.from_codes(keys // n_days, locations),
+        "date": (keys % n_days + min_day).astype("datetime64[D]").astype("datetime64[ns]")
+    }
+    for (df, _), (source_keys, rows) in zip(sources, source_rows):
+        positions = np.searchsorted(keys, source_keys)
+        for col in df.columns.drop(["location", "date"]):
+            joined[col] = _scatter(df[col].values[rows], positions, len(keys))
+    return pd.DataFrame(joined)
+
+def broadcast_by_key(complete_dataset, key, lookups):
+    """
+    Aligns the columns of each lookup dataframe, indexed by values of `key`, to the
+    rows of the complete dataset. The key column is factorized once, so each lookup
+    is only searched for the distinct keys.
+    """
+    key_codes, key_values = pd.factorize(complete_dataset[key])
+    columns = {}
+    for lookup in lookups:
+        # Rows with a missing key point to an extra, empty row
+        positions = np.append(lookup.index.get_indexer(key_values), -1)[key_codes]
+        for col in lookup.columns:
+            columns[col] = take(lookup[col].values, positions, allow_fill=True)
+    return pd.DataFrame(columns, index=complete_dataset.index)
+
+
+def read_macro_variable(var, file):
+    var_df = pd.read_csv(os.path.join(INPUT_DIR, file), usecols=["iso_code", var])
+    var_df = var_df[-var_df["iso_code"].isnull()]
+    var_df[var] = var_df[var].round(3)
+    return var_df
+
+
 def add_macro_variables(complete_dataset, macro_variables):
     """
     Appends a list of 'macro' (non-directly COVID related) variables to the dataset
@@ -229,11 +470,17 @@ def add_macro_variables(complete_dataset, macro_variables):
     """
     original_shape = complete_dataset.shape
 
-    for var, file in macro_variables.items():
-        var_df = pd.read_csv(os.path.join(INPUT_DIR, file), usecols=["iso_code", var])
-        var_df = var_df[-var_df["iso_code"].isnull()]
-        var_df[var] = var_df[var].round(3)
-        complete_dataset = complete_dataset.merge(var_df, on="iso_code", how="left")
+    lookups = [
+        cached_source(
+            f"macro_{var}", read_macro_variable, args=(var, file),
+            input_paths=[os.path.join(INPUT_DIR, file)]
+        ).set_index("iso_code")
+        for var, file in macro_variables.items()
+    ]
+    complete_dataset = pd.concat([
+        complete_dataset,
+        broadcast_by_key(complete_dataset, "iso_code", lookups)
+    ], axis=1)
 
     assert complete_dataset.shape[0] == original_shape[0]
     assert complete_dataset.shape[1] == original_shape[1] + len(macro_variables)
@@ -280,6 +527,96 @@ def get_cgrt():
     return cgrt
 
 
+@contextmanager
+def atomic_output(output_path):
+    """
+    Yields a temporary path next to output_path, which replaces output_path once
+    the block completes. A partially written file is never published.
+    """
+    dir_name, file_name = os.path.split(output_path)
+    stem, ext = os.path.splitext(file_name)
+    tmp_path = os.path.join(dir_name, f".{stem}.tmp{ext}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Names of the sources read from the cache or reloaded during this run
+source_cache_stats = {"hits": [], "misses": []}
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _cache_entry_source(file_name):
+    """
+    Returns the name of the source a file of the source cache was stored for, or None
+    if it isn't a cache entry.
+    """
+    match = re.fullmatch(r"(.+)-[0-9a-f]{16}\.feather", file_name)
+    return match.group(1) if match else None
+
+def cached_source(name, load, args=(), input_paths=(), key_extra=()):
+    """
+    Returns load(*args), reusing the frame stored by a previous run if its inputs are unchanged.
+
+    The cache key hashes the contents of input_paths, the source code of load, args and
+    key_extra (e.g. the current date for sources filtered on it). When an input file is
+    missing, load is always called.
+    """
+    key = hashlib.sha256()
+    for part in (name, inspect.getsource(load), repr(args), *map(str, key_extra)):
+        key.update(part.encode())
+    cacheable = all(os.path.isfile(path) for path in input_paths)
+    if cacheable:
+        for path in input_paths:
+            key.update(_file_digest(path).encode())
+    cache_path = os.path.join(SOURCE_CACHE_DIR, f"{name}-{key.hexdigest()[:16]}.feather")
+
+    if cacheable and os.path.isdir(SOURCE_CACHE_DIR):
+        # Drop the entries stored for previous versions of the inputs
+        for file_name in os.listdir(SOURCE_CACHE_DIR):
+            path = os.path.join(SOURCE_CACHE_DIR, file_name)
+            if _cache_entry_source(file_name) == name and path != cache_path:
+                os.remove(path)
+
+    if cacheable and os.path.isfile(cache_path):
+        print(f"[cache hit] {name}")
+        source_cache_stats["hits"].append(name)
+        return pd.read_feather(cache_path)
+
+    print(f"[cache miss] {name}")
+    source_cache_stats["misses"].append(name)
+    df = load(*args).reset_index(drop=True)
+    if cacheable:
+        os.makedirs(SOURCE_CACHE_DIR, exist_ok=True)
+        with atomic_output(cache_path) as tmp_path:
+            df.to_feather(tmp_path)
+    return df
+
+def prune_source_cache():
+    """
+    Removes the entries of sources that weren't loaded during this run, along with any
+    other file left in the source cache (e.g. by an interrupted write).
+    """
+    if not os.path.isdir(SOURCE_CACHE_DIR):
+        return
+    used = set(source_cache_stats["hits"] + source_cache_stats["misses"])
+    for file_name in os.listdir(SOURCE_CACHE_DIR):
+        if _cache_entry_source(file_name) not in used:
+            os.remove(os.path.join(SOURCE_CACHE_DIR, file_name))
+
+def print_source_cache_stats():
+    hits, misses = source_cache_stats["hits"], source_cache_stats["misses"]
+    print(f"Source cache: {len(hits)} hits, {len(misses)} misses")
+    if misses:
+        print(f"Reloaded: {', '.join(misses)}")
+
 def dict_to_compact_json(d: dict):
     """
     Encodes a Python dict into valid, minified JSON.
@@ -294,29 +631,53 @@ def dict_to_compact_json(d: dict):
         allow_nan=False
     )
 
-def df_to_json(complete_dataset, output_path, static_columns):
+def _records_without_na(df):
+    """
+    Converts a dataframe to a list of records, dropping NA values from each record.
+    """
+    columns = list(df.columns)
+    values = [df[col].tolist() for col in columns]
+    notnull = df.notnull().to_numpy()
+    return [
+        {col: col_values[i] for col, col_values, keep in zip(columns, values, row_notnull) if keep}
+        for i, row_notnull in enumerate(notnull)
+    ]
+
+def df_to_json(complete_dataset, output_path, static_columns, chunk_rows=20000):
     """
     Writes a JSON version of the complete dataset, with the ISO code at the root.
     NA values are dropped from the output.
     Macro variables are normalized by appearing only once, at the root of each ISO code.
+    Countries are streamed to the file one at a time.
     """
-    megajson = {}
-
     static_columns = ["continent", "location"] + list(static_columns)
+    data_columns = [
+        col for col in complete_dataset.columns
+        if col != "iso_code" and col not in static_columns
+    ]
 
-    complete_dataset = complete_dataset.dropna(axis="rows", subset=["iso_code"])
-
-    for iso in complete_dataset.iso_code.unique():
-        country_df = complete_dataset[complete_dataset.iso_code == iso].drop(columns=["iso_code"])
-        static_data = country_df.head(1)[static_columns].to_dict("records")[0]
-        megajson[iso] = {k:v for k,v in static_data.items() if pd.notnull(v)}
-        megajson[iso]["data"] = [
-           {k:v for k,v in r.items() if pd.notnull(v)}
-           for r in country_df.drop(columns=static_columns).to_dict("records")
-        ]
-
-    with open(output_path, "w") as file:
-        file.write(dict_to_compact_json(megajson))
+    # Group rows by ISO code with one stable sort, keeping countries in order of appearance
+    codes, isos = pd.factorize(complete_dataset["iso_code"])
+    order = np.argsort(codes, kind="stable")
+    order = order[codes[order] >= 0]
+    bounds = np.searchsorted(codes[order], np.arange(len(isos) + 1))
+
+    with atomic_output(output_path) as tmp_path, open(tmp_path, "w") as file:
+        file.write("{")
+        block_start = block_stop = 0
+        for i, iso in enumerate(isos):
+            if bounds[i] >= block_stop:
+                # Convert the rows of the next countries, up to chunk_rows, back to the published dtypes
+                block_start = bounds[i]
+                block_stop = bounds[max(i + 1, np.searchsorted(bounds, block_start + chunk_rows, side="right") - 1)]
+                block = output_frame(complete_dataset.iloc[order[block_start:block_stop]])
+            country_df = block.iloc[bounds[i] - block_start:bounds[i + 1] - block_start]
+            country_json = _records_without_na(country_df.head(1)[static_columns])[0]
+            country_json["data"] = _records_without_na(country_df[data_columns])
+            if i > 0:
+                file.write(",")
+            file.write(json.dumps(iso) + ":" + dict_to_compact_json(country_json))
+        file.write("}")
 
 def df_to_columnar_json(complete_dataset, output_path):
     """
@@ -330,31 +691,163 @@ def df_to_columnar_json(complete_dataset, output_path):
             "iso_code": ["AFG", "AFG", ... ],
             "date": ["2020-03-01", "2020-03-02", ... ]
         }
+    Each column is encoded straight from its values and streamed to the file.
     """
+    with atomic_output(output_path) as tmp_path, open(tmp_path, "w") as file:
+        file.write("{")
+        for i, col in enumerate(complete_dataset.columns):
+            if i > 0:
+                file.write(",")
+            file.write(json.dumps(col) + ":" + _json_array(output_frame(complete_dataset[[col]])[col]))
+        file.write("}")
+
+def _json_array(values):
+    """
+    Encodes a column as a compact JSON array, with NA values as null.
+    Numbers are formatted with repr, like json.dumps does.
+    """
+    if values.dtype.kind == "f":
+        array = values.to_numpy()
+        # Like json.dumps with allow_nan=False, infinite values are invalid JSON
+        if np.isinf(array).any():
+            raise ValueError("Out of range float values are not JSON compliant")
+        # Complete whole-number columns are written as integers, as pandas'
+        # where(..., None) used to downcast them
+        if not np.isnan(array).any() and np.array_equal(array, np.trunc(array)):
+            return "[" + ",".join(map(repr, array.astype(np.int64).tolist())) + "]"
+        # "nan" can't appear in the repr of a finite float
+        return "[" + ",".join(map(repr, array.tolist())).replace("nan", "null") + "]"
+    if values.dtype.kind in "iu":
+        return "[" + ",".join(map(repr, values.tolist())) + "]"
     # Replace NaNs with None in order to be serializable to JSON.
     # JSON doesn't support NaNs, but it does have null which is represented as None in Python.
-    columnar_dict = complete_dataset.where(
-        pd.notnull(complete_dataset),
-        None
-    ).to_dict(orient="list")
-    with open(output_path, "w") as file:
-        file.write(dict_to_compact_json(columnar_dict))
+    return dict_to_compact_json([None if pd.isnull(v) else v for v in values.tolist()])
+
+def _float32_lossless(values, decimals=3):
+    """
+    Checks whether float32 reproduces every value of a float column once rounded
+    to the precision the dataset is published with.
+    """
+    values = values.to_numpy()
+    as_float32 = values.astype(np.float32).astype(np.float64)
+    return bool(np.all((np.round(as_float32, decimals) == values) | np.isnan(values)))
+
+def compact_dtypes(df):
+    """
+    Converts the megafile frame to its in-memory schema:
+    - entity columns (CATEGORY_COLUMNS) are categoricals;
+    - dates are datetimes;
+    - float columns only holding integers (counts) are nullable Int32, or Int64 if needed;
+    - other float columns are float32 when no published value changes, otherwise float64.
+    Columns already converted are left as they are, and output_frame reverses it.
+    """
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if col in CATEGORY_COLUMNS:
+            values = values.astype("category")
+        elif col == "date" and not is_datetime64_dtype(values.dtype):
+            values = pd.to_datetime(values, format="%Y-%m-%d")
+        elif values.dtype == np.float64:
+            present = values.dropna().to_numpy()
+            if np.array_equal(present, np.round(present)):
+                int_max = np.abs(present).max() if len(present) else 0
+                values = values.astype("Int32" if int_max < 2 ** 31 else "Int64")
+            elif _float32_lossless(values):
+                values = values.astype(np.float32)
+        columns[col] = values
+    return pd.DataFrame(columns, index=df.index)
+
+def output_frame(df):
+    """
+    Converts (a slice of) the megafile frame back to the dtypes it is published with:
+    object entity columns, YYYY-MM-DD date strings and float64 values.
+    """
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if is_categorical_dtype(values.dtype):
+            values = values.astype(object)
+        elif is_datetime64_dtype(values.dtype):
+            codes, days = pd.factorize(values)
+            values = pd.Series(days.strftime("%Y-%m-%d").to_numpy()[codes], index=df.index)
+        elif values.dtype == np.float32:
+            values = values.astype(np.float64).round(3)
+        elif is_extension_array_dtype(values.dtype) and is_integer_dtype(values.dtype):
+            values = values.astype(np.float64)
+        columns[col] = values
+    return pd.DataFrame(columns, index=df.index)
+
+def df_to_arrow_table(df):
+    """
+    Converts the dataset to an Arrow table for the binary outputs:
+    - location, ISO code and continent are dictionary-encoded;
+    - dates are stored as date32;
+    - float columns are stored as float32 when no published value changes,
+    otherwise as float64 (e.g. large totals and population).
+    """
+    arrays = {}
+    for col in df.columns:
+        # One column at a time is converted back to the published dtypes
+        values = output_frame(df[[col]])[col]
+        if col in ARROW_DICTIONARY_COLUMNS:
+            arrays[col] = pa.array(values, from_pandas=True).dictionary_encode()
+        elif col == "date":
+            arrays[col] = pa.array(pd.to_datetime(values).to_numpy().astype("datetime64[D]"))
+        elif values.dtype == np.float64 and _float32_lossless(values):
+            arrays[col] = pa.array(values.to_numpy(np.float32), from_pandas=True)
+        else:
+            arrays[col] = pa.array(values, from_pandas=True)
+    return pa.table(arrays)
+
+def df_to_parquet(df, output_path):
+    """
+    Writes a Parquet version of the dataset with one row group per location, so that
+    readers can use the row group statistics to only load the countries they filter on.
+    """
+    table = df_to_arrow_table(df)
+    # pyarrow 3 writes the statistics of a dictionary column over its whole dictionary,
+    # so location is stored as plain strings to give each row group its own min/max
+    location_index = table.schema.get_field_index("location")
+    table = table.set_column(location_index, "location", table.column("location").cast(pa.string()))
+    locations = df["location"].to_numpy()
+    bounds = np.concatenate([[0], np.flatnonzero(locations[1:] != locations[:-1]) + 1, [len(df)]])
+    with atomic_output(output_path) as tmp_path:
+        with pq.ParquetWriter(tmp_path, table.schema, compression="zstd") as writer:
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                writer.write_table(table.slice(start, stop - start))
+
+def df_to_feather(df, output_path):
+    """
+    Writes a Feather (Arrow IPC) version of the dataset.
+    """
+    with atomic_output(output_path) as tmp_path:
+        feather.write_feather(df_to_arrow_table(df), tmp_path, compression="zstd")
+
+def write_binary(df, output_path_no_ext):
+    """
+    Writes Parquet and Feather versions of the dataset, next to each other.
+    """
+    df_to_parquet(df, f"{output_path_no_ext}.parquet")
+    df_to_feather(df, f"{output_path_no_ext}.feather")
 
 def create_latest(df):
 
-    df = df[df.date >= str(date.today() - timedelta(weeks = 2))]
-    df = df.sort_values("date")
+    df = output_frame(df[df.date >= str(date.today() - timedelta(weeks = 2))])
+    df = df.sort_values(["location", "date"])
 
-    latest = [df[df.location == loc].ffill().tail(1).round(3) for loc in set(df.location)]
-    latest = pd.concat(latest)
-    latest = latest.sort_values("location").rename(columns={"date": "last_updated_date"})
+    # The last non-missing value of each column is the last row of each location once
+    # forward-filled, so a single grouped pass gives the latest data point
+    latest = df.groupby("location", as_index=False).last()[df.columns].round(3)
+    latest = latest.rename(columns={"date": "last_updated_date"})
 
     print("Writing latest version…")
-    latest.to_csv(os.path.join(DATA_DIR, "latest/owid-covid-latest.csv"), index=False)
-    latest.to_excel(os.path.join(DATA_DIR, "latest/owid-covid-latest.xlsx"), index=False)
-    latest.dropna(subset=["iso_code"]).set_index("iso_code").to_json(
-        os.path.join(DATA_DIR, "latest/owid-covid-latest.json"), orient="index"
-    )
+    with atomic_output(os.path.join(DATA_DIR, "latest/owid-covid-latest.csv")) as tmp_path:
+        latest.to_csv(tmp_path, index=False)
+    with atomic_output(os.path.join(DATA_DIR, "latest/owid-covid-latest.xlsx")) as tmp_path:
+        latest.to_excel(tmp_path, index=False)
+    with atomic_output(os.path.join(DATA_DIR, "latest/owid-covid-latest.json")) as tmp_path:
+        latest.dropna(subset=["iso_code"]).set_index("iso_code").to_json(tmp_path, orient="index")
 
 internal_files_columns = {
     "cases-tests": [
@@ -454,22 +947,94 @@ def create_internal(df):
         "population"
     ]
 
-    df = df.copy()
+    # One projection of the columns of all internal files, shared by every output.
     # Insert CFR column to avoid calculating it on the client, and enable
     # splitting up into cases & deaths columns.
-    df["cfr"] = (df["total_deaths"] * 100 / df["total_cases"]).round(3)
+    totals = output_frame(df[["total_deaths", "total_cases"]])
+    projected_columns = list(dict.fromkeys(
+        col for columns in internal_files_columns.values() for col in columns if col != "cfr"
+    ))
+    cfr = (totals["total_deaths"] * 100 / totals["total_cases"]).round(3)
+    # No CFR without cases: deaths over zero cases would give inf, which isn't valid JSON
+    cfr = cfr.where(np.isfinite(cfr) & (totals["total_cases"] != 0))
+    internal = df[projected_columns].assign(cfr=cfr)
+    notnull = internal.notnull()
 
     for name, columns in internal_files_columns.items():
-        output_path = os.path.join(dir_path, f"megafile--{name}.json")
+        output_path = os.path.join(dir_path, f"megafile--{name}")
         value_columns = list(set(columns) - set(non_value_columns))
-        df_output = df[columns].dropna(subset=value_columns, how="all")
-        df_to_columnar_json(df_output, output_path)
-
+        # Equivalent to dropna(subset=value_columns, how="all")
+        df_output = internal.loc[notnull[value_columns].any(axis=1).to_numpy(), columns]
+        df_to_columnar_json(df_output, f"{output_path}.json")
+        write_binary(df_output, output_path)
+
+
+def write_csv(df, output_path, chunk_rows=20000):
+    # Rows are converted back to the published dtypes one chunk at a time
+    with atomic_output(output_path) as tmp_path, open(tmp_path, "w", newline="") as file:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            output_frame(df.iloc[start:start + chunk_rows]).to_csv(file, header=start == 0, index=False)
+
+def write_xlsx(df, output_path, chunk_rows=20000):
+    # In constant_memory mode xlsxwriter flushes each row as soon as the next one starts,
+    # so the sheet is written row by row instead of holding every cell in memory.
+    # Cells match DataFrame.to_excel: formatted header, empty cells for NAs.
+    with atomic_output(output_path) as tmp_path:
+        workbook = xlsxwriter.Workbook(tmp_path, {"constant_memory": True})
+        worksheet = workbook.add_worksheet("Sheet1")
+        header_format = workbook.add_format({
+            "bold": True, "border": 1, "align": "center", "valign": "top"
+        })
+        worksheet.write_row(0, 0, list(df.columns), header_format)
+        for start in range(0, len(df), chunk_rows):
+            chunk = output_frame(df.iloc[start:start + chunk_rows])
+            for row, values in enumerate(chunk.itertuples(index=False, name=None), start + 1):
+                for col, value in enumerate(values):
+                    if pd.notnull(value):
+                        worksheet.write(row, col, value)
+        workbook.close()
+
+# Dataset shared by the output workers. Under fork it is inherited from the parent
+# process rather than copied to each worker.
+_output_df = None
+
+def _init_output_worker(df):
+    global _output_df
+    _output_df = df
+
+def _run_output_task(func, args):
+    return func(_output_df, *args)
+
+def write_outputs(df, tasks, max_workers=None):
+    """
+    Runs independent serializers of df concurrently in a process pool.
+    Each task is a (function, args) pair, called as function(df, *args).
+    """
+    if max_workers is None:
+        max_workers = min(len(tasks), os.cpu_count() or 1)
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_output_worker,
+        initargs=(df,)
+    ) as executor:
+        futures = [executor.submit(_run_output_task, func, args) for func, args in tasks]
+        # Surface the first failure, if any
+        for future in futures:
+            future.result()
+
+
+def generate_megafile(jhu_long=None):
+    """
+    Builds the megafile and writes all its versions.
+    jhu_long is the long-format JHU frame when called right after the JHU export,
+    otherwise it is read from the cache or the JHU CSV files.
+    """
 
-def generate_megafile():
+    source_cache_stats["hits"].clear()
+    source_cache_stats["misses"].clear()
 
     print("\nFetching JHU dataset…")
-    jhu = get_jhu()
+    jhu = get_jhu(jhu_long)
 
     print("\nFetching reproduction rate…")
     reprod = get_reprod()
@@ -479,36 +1044,57 @@ def generate_megafile():
         print(f"<!> Location '{loc}' has reproduction rates but is absent from JHU data")
 
     print("\nFetching hospital dataset…")
-    hosp = get_hosp()
+    hosp = cached_source(
+        "hosp", get_hosp,
+        input_paths=[os.path.join(GRAPHER_DIR, "COVID-2019 - Hospital & ICU.csv")]
+    )
 
     location_mismatch = set(hosp.location).difference(set(jhu.location))
     for loc in location_mismatch:
         print(f"<!> Location '{loc}' has hospital data but is absent from JHU data")
 
     print("\nFetching testing dataset…")
-    testing = get_testing()
+    testing = cached_source(
+        "testing", get_testing,
+        input_paths=[
+            os.path.join(DATA_DIR, "testing/covid-testing-all-observations.csv"),
+            os.path.join(INPUT_DIR, "owid/secondary_testing_series.csv")
+        ],
+        # Observations for the current day are dropped
+        key_extra=[date.today()]
+    )
 
     location_mismatch = set(testing.location).difference(set(jhu.location))
     for loc in location_mismatch:
         print(f"<!> Location '{loc}' has testing data but is absent from JHU data")
 
     print("\nFetching vaccination dataset…")
-    vax = get_vax()
+    vax = cached_source(
+        "vax", get_vax,
+        input_paths=[os.path.join(DATA_DIR, "vaccinations/vaccinations.csv")]
+    )
     vax = vax[-vax.location.isin(["England", "Northern Ireland", "Scotland", "Wales"])]
 
     print("\nFetching OxCGRT dataset…")
-    cgrt = get_cgrt()
-
-    all_covid = (
-        jhu
-        .merge(reprod, on=["date", "location"], how="left")
-        .merge(hosp, on=["date", "location"], how="outer")
-        .merge(testing, on=["date", "location"], how="outer")
-        .merge(vax, on=["date", "location"], how="outer")
-        .merge(cgrt, on=["date", "location"], how="left")
-        .sort_values(["location", "date"])
+    cgrt = cached_source(
+        "cgrt", get_cgrt,
+        input_paths=[
+            os.path.join(INPUT_DIR, "bsg/latest.csv"),
+            os.path.join(INPUT_DIR, "bsg/bsg_country_standardised.csv")
+        ]
     )
 
+    # Sources are converted to the in-memory schema before being joined, and the
+    # joined frame keeps it until each output is serialized
+    all_covid = join_on_location_date([
+        (compact_dtypes(jhu), "outer"),
+        (compact_dtypes(reprod), "left"),
+        (compact_dtypes(hosp), "outer"),
+        (compact_dtypes(testing), "outer"),
+        (compact_dtypes(vax), "outer"),
+        (compact_dtypes(cgrt), "left"),
+    ])
+
     # Add ISO codes
     print("Adding ISO codes…")
     iso_codes = pd.read_csv(os.path.join(INPUT_DIR, "iso/iso3166_1_alpha_3_codes.csv"))
@@ -518,7 +1104,9 @@ def generate_megafile():
         print(missing_iso)
         raise Exception("Missing ISO code for some locations")
 
-    all_covid = iso_codes.merge(all_covid, on="location")
+    all_covid.insert(0, "iso_code", broadcast_by_key(
+        all_covid, "location", [iso_codes.set_index("location")]
+    )["iso_code"])
 
     # Add continents
     print("Adding continents…")
@@ -529,7 +1117,9 @@ def generate_megafile():
         header=0
     )
 
-    all_covid = continents.merge(all_covid, on="iso_code", how="right")
+    all_covid.insert(1, "continent", broadcast_by_key(
+        all_covid, "iso_code", [continents.set_index("iso_code")]
+    )["continent"])
 
     # Add macro variables
     # - the key is the name of the variable of interest
@@ -551,7 +1141,9 @@ def generate_megafile():
         "life_expectancy": "owid/life_expectancy.csv",
         "human_development_index": "un/human_development_index.csv",
     }
-    all_covid = add_macro_variables(all_covid, macro_variables)
+    all_covid = compact_dtypes(add_macro_variables(all_covid, macro_variables))
+    print_source_cache_stats()
+    prune_source_cache()
 
     # Sort by location and date
     all_covid = all_covid.sort_values(["location", "date"])
@@ -559,20 +1151,17 @@ def generate_megafile():
     # Check that we only have 1 unique row for each location/date pair
     assert all_covid.drop_duplicates(subset=["location", "date"]).shape == all_covid.shape
 
-    # Create light versions of complete dataset with only the latest data point
-    create_latest(all_covid)
-
-    print("Writing to CSV…")
-    all_covid.to_csv(os.path.join(DATA_DIR, "owid-covid-data.csv"), index=False)
-
-    print("Writing to XLSX…")
-    all_covid.to_excel(os.path.join(DATA_DIR, "owid-covid-data.xlsx"), index=False, engine="xlsxwriter")
-
-    print("Writing to JSON…")
-    df_to_json(all_covid, os.path.join(DATA_DIR, "owid-covid-data.json"), macro_variables.keys())
-
-    print("Creating internal files…")
-    create_internal(all_covid)
+    print("Writing outputs…")
+    write_outputs(all_covid, [
+        # Slowest first, so that it starts even if there are fewer workers than tasks
+        (write_xlsx, (os.path.join(DATA_DIR, "owid-covid-data.xlsx"),)),
+        (df_to_json, (os.path.join(DATA_DIR, "owid-covid-data.json"), list(macro_variables.keys()))),
+        (create_internal, ()),
+        (write_csv, (os.path.join(DATA_DIR, "owid-covid-data.csv"),)),
+        (write_binary, (os.path.join(DATA_DIR, "owid-covid-data"),)),
+        # Light versions of complete dataset with only the latest data point
+        (create_latest, ()),
+    ])
 
     # Store the last updated time
     timestamp_filename = os.path.join(DATA_DIR, "owid-covid-data-last-updated-timestamp.txt")
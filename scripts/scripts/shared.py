@@ -2,7 +2,10 @@ import sys
 import pandas as pd
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from datetime import datetime
+from functools import lru_cache
 
 CURRENT_DIR = os.path.dirname(__file__)
 sys.path.append(CURRENT_DIR)
@@ -17,35 +20,34 @@ EU_COUNTRIES_CSV_PATH = os.path.join(CURRENT_DIR, '../input/owid/eu_countries.cs
 ZERO_DAY = "2020-01-21"
 zero_day = datetime.strptime(ZERO_DAY, "%Y-%m-%d")
 
-# =========
-# Utilities
-# =========
-
-def _find_closest_year_row(df, year=2020):
-    """Returns the row which is closest to the year specified (in either direction)"""
-    df = df.copy()
-    df['year'] = df['year'].sort_values(ascending=True)
-    return df.loc[df['year'].map(lambda x: abs(x - 2020)).idxmin()]
-
-
 # ============
 # Loading data
 # ============
 
-def load_population(year=2020):
+# Reference files are only read on first use and then memoized for the rest of
+# the process. Loaders returning frames hand out copies so callers can't alter the cache.
+
+@lru_cache(maxsize=None)
+def _read_population(year):
     df = pd.read_csv(
         POPULATION_CSV_PATH,
         keep_default_na=False,
         usecols=["entity", "year", "population"]
     )
-    return pd.DataFrame([
-        _find_closest_year_row(df_group, year)
-        for loc, df_group in df.groupby('entity')
-    ]) \
-    .dropna() \
-    .rename(columns={'entity': 'location', 'year': 'population_year'})
+    # Keep the row closest to the year specified (in either direction), the first one on ties
+    df = df.assign(distance=(df['year'] - year).abs()) \
+        .sort_values(['entity', 'distance'], kind='mergesort') \
+        .drop_duplicates(subset='entity', keep='first') \
+        .drop(columns='distance')
+    return df \
+        .dropna() \
+        .rename(columns={'entity': 'location', 'year': 'population_year'})
 
-def load_owid_continents():
+def load_population(year=2020):
+    return _read_population(year).copy()
+
+@lru_cache(maxsize=None)
+def _read_owid_continents():
     return pd.read_csv(
         CONTINENTS_CSV_PATH,
         keep_default_na=False,
@@ -54,11 +56,11 @@ def load_owid_continents():
         usecols=['location', 'continent']
     )
 
-locations_by_continent = load_owid_continents() \
-    .groupby('continent')['location'].apply(list) \
-    .to_dict()
+def load_owid_continents():
+    return _read_owid_continents().copy()
 
-def load_wb_income_groups():
+@lru_cache(maxsize=None)
+def _read_wb_income_groups():
     return pd.read_csv(
         WB_INCOME_GROUPS_CSV_PATH,
         keep_default_na=False,
@@ -67,7 +69,11 @@ def load_wb_income_groups():
         usecols=['location', 'income_group']
     )
 
-def load_eu_country_names():
+def load_wb_income_groups():
+    return _read_wb_income_groups().copy()
+
+@lru_cache(maxsize=None)
+def _read_eu_country_names():
     df = pd.read_csv(
         EU_COUNTRIES_CSV_PATH,
         keep_default_na=False,
@@ -75,11 +81,20 @@ def load_eu_country_names():
         names=['location', 'eu'],
         usecols=['location']
     )
-    return df['location'].tolist()
+    return tuple(df['location'])
 
-locations_by_wb_income_group = load_wb_income_groups() \
-    .groupby('income_group')['location'].apply(list) \
-    .to_dict()
+def load_eu_country_names():
+    return list(_read_eu_country_names())
+
+def get_locations_by_continent():
+    return _read_owid_continents() \
+        .groupby('continent')['location'].apply(list) \
+        .to_dict()
+
+def get_locations_by_wb_income_group():
+    return _read_wb_income_groups() \
+        .groupby('income_group')['location'].apply(list) \
+        .to_dict()
 
 
 # ==============
@@ -110,61 +125,96 @@ def inject_per_million(df, measures):
 # OWID continents + custom aggregates
 # ===================================
 
-aggregates_spec = {
-    'World': {
-        'include': None,
-        'exclude': None
-    },
-    'World excl. China': {
-        'exclude': ['China']
-    },
-    'World excl. China and South Korea': {
-        'exclude': ['China', 'South Korea']
-    },
-    'World excl. China, South Korea, Japan and Singapore': {
-        'exclude': ['China', 'South Korea', 'Japan', 'Singapore']
-    },
-    # European Union
-    'European Union': {
-        'include': load_eu_country_names()
-    },
-    # OWID continents
-    **{
-        continent: { 'include': locations, 'exclude': None }
-        for continent, locations in locations_by_continent.items()
-    },
-    # Asia without China
-    'Asia excl. China': {
-        'include': list(
-            set(locations_by_continent['Asia']) - set(['China'])
-        )
-    },
-    # World Bank income groups
-    **{
-        income_group: { 'include': locations, 'exclude': None }
-        for income_group, locations in locations_by_wb_income_group.items()
+@lru_cache(maxsize=None)
+def _read_aggregates_spec():
+    locations_by_continent = get_locations_by_continent()
+    locations_by_wb_income_group = get_locations_by_wb_income_group()
+    return {
+        'World': {
+            'include': None,
+            'exclude': None
+        },
+        'World excl. China': {
+            'exclude': ['China']
+        },
+        'World excl. China and South Korea': {
+            'exclude': ['China', 'South Korea']
+        },
+        'World excl. China, South Korea, Japan and Singapore': {
+            'exclude': ['China', 'South Korea', 'Japan', 'Singapore']
+        },
+        # European Union
+        'European Union': {
+            'include': load_eu_country_names()
+        },
+        # OWID continents
+        **{
+            continent: { 'include': locations, 'exclude': None }
+            for continent, locations in locations_by_continent.items()
+        },
+        # Asia without China
+        'Asia excl. China': {
+            'include': list(
+                set(locations_by_continent['Asia']) - set(['China'])
+            )
+        },
+        # World Bank income groups
+        **{
+            income_group: { 'include': locations, 'exclude': None }
+            for income_group, locations in locations_by_wb_income_group.items()
+        }
     }
-}
 
-def _sum_aggregate(df, name, include=None, exclude=None):
-    df = df.copy()
-    if include:
-        df = df[df['location'].isin(include)]
-    if exclude:
-        df = df[~df['location'].isin(exclude)]
-    df = df.groupby('date') \
-        .sum() \
-        .reset_index()
-    df['location'] = name
-    return df
+def get_aggregates_spec():
+    return deepcopy(_read_aggregates_spec())
+
+def _aggregate_membership(locations, aggregates_spec):
+    """
+    Returns a (location × aggregate) matrix with 1 where the location is part of the aggregate.
+    The extra last row stands for rows without a location, which only unfiltered aggregates count.
+    """
+    membership = np.ones((len(locations) + 1, len(aggregates_spec)))
+    for i, params in enumerate(aggregates_spec.values()):
+        if params.get('include'):
+            membership[:-1, i] *= locations.isin(params['include'])
+            membership[-1, i] = 0
+        if params.get('exclude'):
+            membership[:-1, i] *= ~locations.isin(params['exclude'])
+    return membership
 
 def inject_owid_aggregates(df):
+    # Every measure is pivoted to a (date × location) array and multiplied by the
+    # membership matrix, so all aggregates of a measure come out of a single product
+    date_codes, dates = pd.factorize(df['date'], sort=True)
+    location_codes, locations = pd.factorize(df['location'])
+    location_codes[location_codes < 0] = len(locations)
+    aggregates_spec = get_aggregates_spec()
+    membership = _aggregate_membership(locations, aggregates_spec)
+
+    rows = date_codes >= 0
+    shape = (len(dates), len(locations) + 1)
+    cells = date_codes[rows] * shape[1] + location_codes[rows]
+    def pivot(values):
+        return np.bincount(cells, weights=values[rows], minlength=shape[0] * shape[1]).reshape(shape)
+
+    # An aggregate only has a row for dates on which at least one of its members has one
+    has_rows = (pivot(np.ones(len(df))) @ membership).T > 0
+    aggregate_idx, date_idx = np.nonzero(has_rows)
+    aggregates = pd.DataFrame({
+        'date': dates[date_idx],
+        'location': np.array(list(aggregates_spec.keys()), dtype=object)[aggregate_idx]
+    })
+    for col in df.columns:
+        if col in ['date', 'location'] or not pd.api.types.is_numeric_dtype(df[col]):
+            continue
+        values = np.nan_to_num(df[col].to_numpy(dtype=float, na_value=np.nan))
+        aggregates[col] = (pivot(values) @ membership).T[has_rows]
+        if pd.api.types.is_integer_dtype(df[col]):
+            aggregates[col] = aggregates[col].astype(df[col].dtype)
+
     return pd.concat([
         df,
-        *[
-            _sum_aggregate(df, name, **params)
-            for name, params in aggregates_spec.items()
-        ]
+        aggregates[[col for col in df.columns if col in aggregates.columns]]
     ], sort=True, ignore_index=True)
 
 
@@ -262,63 +312,185 @@ days_since_spec = {
     },
 }
 
-def _get_date_of_threshold(df, col, threshold):
-    try:
-        return df['date'][df[col] >= threshold].iloc[0]
-    except:
-        return None
-
-def _date_diff(a, b, positive_only=False):
-    if pd.isnull(a) or pd.isnull(b):
-        return None
-    diff = (a - b).days
-    if positive_only and diff < 0:
-        return None
+def _to_day_index(dates):
+    """Converts a series of dates to an int64 number of days since the epoch"""
+    return pd.to_datetime(dates).values.astype('datetime64[D]').astype(np.int64)
+
+def _first_threshold_days(codes, days, reached, n_locations):
+    """Returns the day on which each location first reached the threshold (NaN if it never did)"""
+    rows = np.flatnonzero(reached & (codes >= 0))
+    # return_index gives the first occurrence, i.e. the earliest row of each location
+    location_codes, first_rows = np.unique(codes[rows], return_index=True)
+    ref_days = np.full(n_locations, np.nan)
+    ref_days[location_codes] = days[rows[first_rows]]
+    return ref_days
+
+def _days_since(codes, days, values, spec, n_locations):
+    """Returns the number of days since each location first reached the spec's threshold"""
+    with np.errstate(invalid='ignore'):
+        reached = values >= spec['value_threshold']
+    ref_days = _first_threshold_days(codes, days, reached, n_locations)
+    diff = days - ref_days[codes]
+    if spec['positive_only']:
+        with np.errstate(invalid='ignore'):
+            diff[diff < 0] = np.nan
     return diff
 
-def _days_since(df, spec):
-    ref_date = pd.to_datetime(_get_date_of_threshold(df, spec['value_col'], spec['value_threshold']))
-    return pd.to_datetime(df['date']).map(lambda date: _date_diff(
-        date, ref_date, spec['positive_only']
-    )).astype('Int64')
-
-def inject_days_since(df):
+def inject_days_since(df, columns_spec=None):
+    """
+    Adds the days_since_spec columns, or those of columns_spec when given.
+    Rows are expected in date order within each location.
+    """
     df = df.copy()
-    for col, spec in days_since_spec.items():
-        df[col] = df[['date', 'location', spec['value_col']]].groupby('location') \
-            .apply(lambda df_group: _days_since(df_group, spec)) \
-            .reset_index(level=0, drop=True)
+    codes, locations = pd.factorize(df['location'])
+    days = _to_day_index(df['date'])
+    valid = (codes >= 0) & df['date'].notnull().to_numpy()
+    for col, spec in (days_since_spec if columns_spec is None else columns_spec).items():
+        values = df[spec['value_col']].to_numpy(dtype=float, na_value=np.nan)
+        diff = _days_since(codes, days, values, spec, len(locations))
+        diff[~valid] = np.nan
+        df[col] = pd.Series(diff, index=df.index).astype('Int64')
     return df
 
 
+# ===============
+# Rolling windows
+# ===============
+
+def _positions_in_location(codes):
+    """Returns the position of each row within its location, for codes sorted by location"""
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    lengths = np.diff(np.r_[starts, len(codes)])
+    return np.arange(len(codes)) - np.repeat(starts, lengths)
+
+def _location_windows(df):
+    """
+    Returns the row order that sorts df by (location, date), along with the
+    sorted location codes and the position of each sorted row within its location.
+    """
+    codes, _ = pd.factorize(df['location'])
+    order = np.lexsort((_to_day_index(df['date']), codes))
+    codes = codes[order]
+    return order, codes, _positions_in_location(codes)
+
+def _unsort(values, order):
+    """Puts values computed in sorted order back in the original row order"""
+    unsorted = np.empty(len(values))
+    unsorted[order] = values
+    return unsorted
+
+def _trailing_sums(values, positions, windows):
+    """
+    Yields the (window, sums, counts) of non-null values over each trailing window.
+    All windows are built up in a single pass over the shifted values, never
+    crossing location boundaries.
+    """
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0)
+    sums = filled.copy()
+    counts = present.astype(float)
+    for shift in range(1, max(windows)):
+        if shift in windows:
+            yield shift, sums.copy(), counts.copy()
+        in_window = positions[shift:] >= shift
+        sums[shift:] += np.where(in_window, filled[:-shift], 0)
+        counts[shift:] += in_window & present[:-shift]
+    yield max(windows), sums, counts
+
+def _shift_within_location(values, positions, periods):
+    """Equivalent of a grouped shift(periods) for values sorted by location"""
+    shifted = np.full(len(values), np.nan)
+    shifted[periods:] = values[:-periods]
+    shifted[positions < periods] = np.nan
+    return shifted
+
+def _pct_change_within_location(values, positions, periods):
+    """Equivalent of a grouped pct_change(periods, fill_method=None) for values sorted by location"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return values / _shift_within_location(values, positions, periods) - 1
+
+def _rolling_stats(values, spec, positions, grouped):
+    """
+    Computes the rolling statistics in spec over arrays sorted by (location, date).
+    `values` maps each source column to its float array; `grouped` is False for
+    rows without a location, which get NaN like they would in a groupby.
+    """
+    by_source = {}
+    for col, col_spec in spec.items():
+        if col_spec.get('center'):
+            raise ValueError('Centered rolling windows are not supported: %s' % col)
+        source = (col_spec['col'], col_spec.get('fillna'))
+        by_source.setdefault(source, []).append(col)
+
+    result = {}
+    for (source_col, fill_value), cols in by_source.items():
+        source_values = values[source_col]
+        if fill_value is not None:
+            source_values = np.where(np.isnan(source_values), fill_value, source_values)
+        window_sizes = set(spec[col]['window'] for col in cols)
+        for window, sums, counts in _trailing_sums(source_values, positions, window_sizes):
+            for col in cols:
+                col_spec = spec[col]
+                if col_spec['window'] != window:
+                    continue
+                if col_spec.get('stat', 'mean') == 'mean':
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        stat = sums / counts
+                else:
+                    stat = sums.copy()
+                stat[(counts < col_spec['min_periods']) | ~grouped] = np.nan
+                result[col] = stat
+    return {col: result[col] for col in spec}
+
+def rolling_windows(df, spec, windows=None):
+    """
+    Computes right-aligned rolling means or sums for every entry in spec.
+    Each entry needs 'col', 'window' and 'min_periods', and may set 'stat'
+    ('mean' by default, or 'sum') and 'fillna'. The frame is sorted by
+    (location, date) once, and all windows of a source column are computed
+    together. Windows count rows, not calendar days, like DataFrame.rolling.
+    """
+    order, codes, positions = windows if windows is not None else _location_windows(df)
+    values = {
+        col_spec['col']: df[col_spec['col']].to_numpy(dtype=float, na_value=np.nan)[order]
+        for col_spec in spec.values()
+    }
+    stats = _rolling_stats(values, spec, positions, codes >= 0)
+    return pd.DataFrame({
+        col: _unsort(stat, order) for col, stat in stats.items()
+    }, index=df.index)
+
+
 # ===================
 # Case Fatality Ratio
 # ===================
 
-def _apply_row_cfr_100(row):
-    if pd.notnull(row['total_cases']) and row['total_cases'] >= 100:
-        return row['cfr']
-    return pd.NA
+def _cfr(deaths, cases):
+    """Deaths as a percentage of cases, NaN where there are no cases (or the ratio isn't finite)"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cfr = (deaths / cases) * 100
+    cfr[(cases == 0) | ~np.isfinite(cfr)] = np.nan
+    return np.round(cfr, decimals=3)
+
+def _cfr_short_term(deaths_avg, cases_avg, positions):
+    """CFR from the 7-day average of deaths and that of cases 13 days earlier, for arrays sorted by location"""
+    return _cfr(deaths_avg, _shift_within_location(cases_avg, positions, 13))
 
 def inject_cfr(df):
-    cfr_series = (df['total_deaths'] / df['total_cases']) * 100
-    df['cfr'] = cfr_series.round(decimals=3)
-    df['cfr_100_cases'] = df.apply(_apply_row_cfr_100, axis=1)
-
-    shifted_cases = (
-        df.sort_values('date')
-        .groupby('location')
-        ['new_cases_7_day_avg_right']
-        .shift(13)
-    )
-    df['cfr_short_term'] = (
-        df['new_deaths_7_day_avg_right']
-        .div(shifted_cases)
-        .replace(np.inf, np.nan)
-        .replace(-np.inf, np.nan)
-        .mul(100)
-        .round(3)
+    df['cfr'] = _cfr(
+        df['total_deaths'].to_numpy(dtype=float, na_value=np.nan),
+        df['total_cases'].to_numpy(dtype=float, na_value=np.nan)
     )
+    df['cfr_100_cases'] = df['cfr'].where(df['total_cases'] >= 100)
+
+    order, codes, positions = _location_windows(df)
+    deaths_avg, cases_avg = [
+        df[col].to_numpy(dtype=float, na_value=np.nan)[order]
+        for col in ['new_deaths_7_day_avg_right', 'new_cases_7_day_avg_right']
+    ]
+    cfr_short_term = _cfr_short_term(deaths_avg, cases_avg, positions)
+    cfr_short_term[codes < 0] = np.nan
+    df['cfr_short_term'] = _unsort(cfr_short_term, order)
 
     return df
 
@@ -380,11 +552,7 @@ rolling_avg_spec = {
 
 def inject_rolling_avg(df):
     df = df.copy().sort_values(by='date')
-    for col, spec in rolling_avg_spec.items():
-        df[col] = df[spec['col']].astype('float')
-        df[col] = df.groupby('location', as_index=False)[col] \
-            .rolling(window=spec['window'], min_periods=spec['min_periods'], center=spec['center']) \
-            .mean().round(decimals=5).reset_index(level=0, drop=True)
+    df = df.assign(**rolling_windows(df, rolling_avg_spec).round(decimals=5))
     return df
 
 
@@ -396,24 +564,16 @@ def inject_exemplars(df):
     df = inject_population(df)
 
     # Inject days since 100th case IF population ≥ 5M
-    def mapper_days_since(row):
-        if pd.notnull(row['population']) and row['population'] >= 5e6:
-            return row['days_since_100_total_cases']
-        return pd.NA
-    df['days_since_100_total_cases_and_5m_pop'] = df.apply(mapper_days_since, axis=1)
+    has_5m_pop = df['population'] >= 5e6
+    df['days_since_100_total_cases_and_5m_pop'] = df['days_since_100_total_cases'].where(has_5m_pop)
 
     # Inject boolean when all exenplar conditions hold
     # Use int because the Grapher doesn't handle non-ints very well
-    countries_with_testing_data = set(megafile.get_testing()['location'])
-    def mapper_bool(row):
-        if pd.notnull(row['days_since_100_total_cases']) and \
-            pd.notnull(row['population']) and \
-            row['days_since_100_total_cases'] >= 21 and \
-            row['population'] >= 5e6 and \
-            row['location'] in countries_with_testing_data:
-            return 1
-        return 0
-    df['5m_pop_and_21_days_since_100_cases_and_testing'] = df.apply(mapper_bool, axis=1)
+    countries_with_testing_data = megafile.get_testing_locations()
+    is_exemplar = (df['days_since_100_total_cases'] >= 21).fillna(False) & \
+        has_5m_pop & \
+        df['location'].isin(countries_with_testing_data)
+    df['5m_pop_and_21_days_since_100_cases_and_testing'] = is_exemplar.astype(int)
 
     return drop_population(df)
 
@@ -441,20 +601,32 @@ doubling_days_spec = {
     },
 }
 
-def pct_change_to_doubling_days(pct_change, periods):
-    if pd.notnull(pct_change) and pct_change != 0:
+def _doubling_days_source(values):
+    # Zeros are treated as missing so that a series starting from 0 doesn't yield infinite growth
+    values = values.copy()
+    values[values == 0] = np.nan
+    return values
+
+def _doubling_days(values, positions, periods):
+    """Returns the doubling days over `periods` rows, for arrays sorted by location"""
+    pct_change = _pct_change_within_location(values, positions, periods)
+    with np.errstate(invalid='ignore', divide='ignore'):
         doubling_days = periods * np.log(2) / np.log(1 + pct_change)
-        return np.round(doubling_days, decimals=2)
-    return pd.NA
+    doubling_days[pct_change == 0] = np.nan
+    return np.round(doubling_days, decimals=2)
 
 def inject_doubling_days(df):
+    order, codes, positions = _location_windows(df)
+    values = {
+        spec['value_col']: _doubling_days_source(
+            df[spec['value_col']].to_numpy(dtype=float, na_value=np.nan)[order]
+        )
+        for spec in doubling_days_spec.values()
+    }
     for col, spec in doubling_days_spec.items():
-        value_col = spec['value_col']
-        periods = spec['periods']
-        df.loc[df[value_col] == 0, value_col] = np.nan
-        df[col] = df.groupby('location', as_index=False) \
-            [value_col].pct_change(periods=periods, fill_method=None) \
-            [value_col].map(lambda pct: pct_change_to_doubling_days(pct, periods))
+        doubling_days = _doubling_days(values[spec['value_col']], positions, spec['periods'])
+        doubling_days[codes < 0] = np.nan
+        df[col] = _unsort(doubling_days, order)
     return df
 
 
@@ -462,29 +634,232 @@ def inject_doubling_days(df):
 # Weekly & biweekly growth calculation
 # ====================================
 
-def _inject_growth(df, prefix, periods):
-    cases_colname = '%s_cases' % prefix
-    deaths_colname = '%s_deaths' % prefix
-    cases_growth_colname = '%s_pct_growth_cases' % prefix
-    deaths_growth_colname = '%s_pct_growth_deaths' % prefix
-
-    df[[cases_colname, deaths_colname]] = df[['location', 'new_cases', 'new_deaths']].fillna(0) \
-        .groupby('location')[['new_cases', 'new_deaths']] \
-        .rolling(window=periods, min_periods=periods, center=False) \
-        .sum().reset_index(level=0, drop=True)
-    df[[cases_growth_colname, deaths_growth_colname]] = df[['location', cases_colname, deaths_colname]] \
-        .groupby('location')[[cases_colname, deaths_colname]] \
-        .pct_change(periods=periods, fill_method=None) \
-        .replace([np.inf, -np.inf], pd.NA) * 100
+growth_spec = {
+    'weekly': 7,
+    'biweekly': 14,
+}
+
+def _growth_windows_spec(prefix, periods):
+    return {
+        '%s_%s' % (prefix, measure): {
+            'col': 'new_%s' % measure,
+            'window': periods,
+            'min_periods': periods,
+            'stat': 'sum',
+            'fillna': 0
+        }
+        for measure in ['cases', 'deaths']
+    }
 
+def _pct_growth(sums, positions, periods):
+    """Percentage growth over `periods` rows, for arrays sorted by location"""
+    pct_change = _pct_change_within_location(sums, positions, periods)
+    pct_change[np.isinf(pct_change)] = np.nan
+    return pct_change * 100
+
+def _inject_growth(df, prefix, periods):
+    windows = _location_windows(df)
+    order, codes, positions = windows
+    sums = rolling_windows(df, _growth_windows_spec(prefix, periods), windows)
+    df[list(sums.columns)] = sums
+    for measure in ['cases', 'deaths']:
+        growth = _pct_growth(sums['%s_%s' % (prefix, measure)].to_numpy()[order], positions, periods)
+        growth[codes < 0] = np.nan
+        df['%s_pct_growth_%s' % (prefix, measure)] = _unsort(growth, order)
     return df
 
 def inject_weekly_growth(df):
-    return _inject_growth(df, 'weekly', 7)
+    return _inject_growth(df, 'weekly', growth_spec['weekly'])
 
 def inject_biweekly_growth(df):
-    return _inject_growth(df, 'biweekly', 14)
+    return _inject_growth(df, 'biweekly', growth_spec['biweekly'])
+
+
+# ===============
+# Derivation plan
+# ===============
+
+BASE_VALUE_COLS = ['new_cases', 'new_deaths', 'total_cases', 'total_deaths']
+
+# Number of earlier rows of the same location that a row's windowed columns depend on:
+# the biweekly growth compares 14-row sums taken 14 rows apart
+DERIVED_LOOKBACK_ROWS = 2 * max(growth_spec.values()) - 1
+
+def _windowed_columns(values, positions, grouped, population, per_million_measures):
+    """
+    Computes the columns that only depend on the last DERIVED_LOOKBACK_ROWS rows of each
+    location: growth, doubling days, per million, rolling averages and CFR.
+    `values` holds the base columns as float arrays sorted by (location, date), and
+    is extended with the derived columns as they are computed.
+    """
+    derived = {}
+    def add(col, col_values):
+        values[col] = col_values
+        derived[col] = col_values
+
+    # Weekly & biweekly growth
+    sums = _rolling_stats(values, {
+        col: col_spec
+        for prefix, periods in growth_spec.items()
+        for col, col_spec in _growth_windows_spec(prefix, periods).items()
+    }, positions, grouped)
+    for prefix, periods in growth_spec.items():
+        for measure in ['cases', 'deaths']:
+            add('%s_%s' % (prefix, measure), sums['%s_%s' % (prefix, measure)])
+        for measure in ['cases', 'deaths']:
+            growth = _pct_growth(sums['%s_%s' % (prefix, measure)], positions, periods)
+            growth[~grouped] = np.nan
+            add('%s_pct_growth_%s' % (prefix, measure), growth)
+
+    # Doubling days
+    doubling_days_sources = {
+        spec['value_col']: _doubling_days_source(values[spec['value_col']])
+        for spec in doubling_days_spec.values()
+    }
+    for col, spec in doubling_days_spec.items():
+        doubling_days = _doubling_days(doubling_days_sources[spec['value_col']], positions, spec['periods'])
+        doubling_days[~grouped] = np.nan
+        add(col, doubling_days)
 
+    # Per million
+    for measure in per_million_measures:
+        add(measure + '_per_million', np.round(values[measure] / (population / 1e6), decimals=3))
+
+    # Rolling averages
+    for col, stat in _rolling_stats(values, rolling_avg_spec, positions, grouped).items():
+        add(col, np.round(stat, decimals=5))
+
+    # Case fatality ratio
+    cfr = _cfr(values['total_deaths'], values['total_cases'])
+    add('cfr', cfr)
+    with np.errstate(invalid='ignore'):
+        add('cfr_100_cases', np.where(values['total_cases'] >= 100, cfr, np.nan))
+    cfr_short_term = _cfr_short_term(
+        values['new_deaths_7_day_avg_right'], values['new_cases_7_day_avg_right'], positions
+    )
+    cfr_short_term[~grouped] = np.nan
+    add('cfr_short_term', cfr_short_term)
+
+    return derived
+
+def _match_previous(previous, values, locations, sort_codes, days):
+    """
+    Matches the rows of df, sorted by (location, date), to those of `previous` on
+    integer (location, day) keys. Returns, for every row, the matching row of
+    `previous` (-1 if none) and whether it is stale, i.e. on or after the first date
+    on which that location's base values differ from, or are missing in, `previous`.
+    """
+    previous_codes = locations.get_indexer(previous['location'])
+    previous_codes[previous_codes < 0] = len(locations)
+    previous_days = _to_day_index(previous['date'])
+    min_day = min(days.min(), previous_days.min())
+    span = max(days.max(), previous_days.max()) - min_day + 1
+    keys = sort_codes * span + (days - min_day)
+    previous_keys = previous_codes * span + (previous_days - min_day)
+
+    previous_order = np.argsort(previous_keys, kind='mergesort')
+    found_at = np.searchsorted(previous_keys, keys, sorter=previous_order).clip(max=len(previous_keys) - 1)
+    previous_rows = previous_order[found_at]
+    found = previous_keys[previous_rows] == keys
+    previous_rows[~found] = -1
+
+    changed = ~found
+    for col in BASE_VALUE_COLS:
+        current = values[col][found]
+        prior = previous[col].to_numpy(dtype=float, na_value=np.nan)[previous_rows[found]]
+        changed[found] |= ~((current == prior) | (np.isnan(current) & np.isnan(prior)))
+    # Rows that only exist in previous also invalidate what comes after them
+    removed = ~np.isin(previous_keys, keys)
+
+    first_changed_days = np.full(len(locations) + 2, np.iinfo(np.int64).max)
+    np.minimum.at(first_changed_days, sort_codes[changed], days[changed])
+    np.minimum.at(first_changed_days, previous_codes[removed], previous_days[removed])
+    return previous_rows, days >= first_changed_days[sort_codes]
+
+def inject_derived_columns(df, per_million_measures, previous=None):
+    """
+    Fused equivalent of inject_weekly_growth, inject_biweekly_growth,
+    inject_doubling_days, inject_per_million, inject_rolling_avg, inject_cfr,
+    inject_days_since and inject_exemplars applied in that order, followed by
+    a sort on (location, date).
+
+    The frame is sorted and grouped by location once, every derived column is
+    computed on NumPy arrays in that order, and the result is materialized in a
+    single DataFrame. The step-by-step functions remain as the reference path.
+
+    If `previous` (an earlier output of this function) is passed, windowed columns
+    are only recomputed from the first changed date of each location, using the
+    DERIVED_LOOKBACK_ROWS rows before it as context, and reused from `previous`
+    for earlier rows. Days-since and exemplar columns are always computed over the
+    whole history, so the output is the same as a full recompute.
+    """
+    codes, locations = pd.factorize(df['location'], sort=True)
+    # Rows without a location sort last, as in sort_values()
+    sort_codes = np.where(codes < 0, len(locations), codes)
+    days = _to_day_index(df['date'])
+    order = np.lexsort((days, sort_codes))
+    codes, days, sort_codes = codes[order], days[order], sort_codes[order]
+    positions = _positions_in_location(sort_codes)
+    grouped = codes >= 0
+    valid = grouped & df['date'].notnull().to_numpy()[order]
+    index = df.index[order]
+
+    values = {
+        col: df[col].to_numpy(dtype=float, na_value=np.nan)[order]
+        for col in BASE_VALUE_COLS
+    }
+    population = load_population().set_index('location')['population'] \
+        .reindex(locations).to_numpy(dtype=float)
+    population = np.append(population, np.nan)[codes]
+
+    if previous is None or previous.empty:
+        derived = _windowed_columns(values, positions, grouped, population, per_million_measures)
+    else:
+        previous_rows, stale = _match_previous(previous, values, locations, sort_codes, days)
+        # Recompute each location from DERIVED_LOOKBACK_ROWS rows before its first stale row
+        first_stale = np.full(len(locations) + 1, np.iinfo(np.int64).max)
+        np.minimum.at(first_stale, sort_codes[stale], positions[stale])
+        needed = positions >= first_stale[sort_codes] - DERIVED_LOOKBACK_ROWS
+        recomputed = _windowed_columns(
+            {col: col_values[needed] for col, col_values in values.items()},
+            _positions_in_location(sort_codes[needed]),
+            grouped[needed],
+            population[needed],
+            per_million_measures
+        )
+        if set(recomputed).issubset(previous.columns):
+            derived = {}
+            for col, col_values in recomputed.items():
+                derived[col] = previous[col].to_numpy(dtype=float, na_value=np.nan)[previous_rows]
+                derived[col][stale] = col_values[stale[needed]]
+                values[col] = derived[col]
+        else:
+            # The previous output predates a change in the derived columns
+            derived = _windowed_columns(values, positions, grouped, population, per_million_measures)
+
+    # Days since
+    for col, spec in days_since_spec.items():
+        diff = _days_since(codes, days, values[spec['value_col']], spec, len(locations))
+        diff[~valid] = np.nan
+        values[col] = derived[col] = diff
+
+    # Exemplars
+    with np.errstate(invalid='ignore'):
+        has_5m_pop = population >= 5e6
+        has_100_cases_21_days_ago = values['days_since_100_total_cases'] >= 21
+    has_testing_data = np.append(locations.isin(megafile.get_testing_locations()), False)[codes]
+    derived['days_since_100_total_cases_and_5m_pop'] = np.where(
+        has_5m_pop, values['days_since_100_total_cases'], np.nan
+    )
+    derived['5m_pop_and_21_days_since_100_cases_and_testing'] = \
+        (has_100_cases_21_days_ago & has_5m_pop & has_testing_data).astype(int)
+
+    for col in [*days_since_spec.keys(), 'days_since_100_total_cases_and_5m_pop']:
+        derived[col] = pd.Series(derived[col], index=index).astype('Int64')
+    return pd.DataFrame({
+        **{col: df[col].values[order] for col in df.columns},
+        **derived
+    }, index=index)
 
 # ============
 # Export logic
@@ -582,34 +957,49 @@ GRAPHER_COL_NAMES = {
 def existsin(l1, l2):
     return [x for x in l1 if x in l2]
 
-def standard_export(df, output_path, grapher_name):
-    # Grapher
-    df_grapher = df.copy()
-    df_grapher['date'] = pd.to_datetime(df_grapher['date']).map(lambda date: (date - zero_day).days)
-    df_grapher = df_grapher[GRAPHER_COL_NAMES.keys()] \
-        .rename(columns=GRAPHER_COL_NAMES) \
-        .to_csv(os.path.join(output_path, '%s.csv' % grapher_name), index=False)
-
-    # Table & public extracts for external users
-    # Excludes aggregates
-    excluded_aggregates = list(set(aggregates_spec.keys()) - set([
+def standard_table(df):
+    """
+    Returns the rows of df published in the table & public extracts for external users,
+    i.e. without the aggregates other than continents, the EU and World.
+    """
+    excluded_aggregates = list(set(get_aggregates_spec().keys()) - set([
         'World', 'North America', 'South America', 'Europe', 'Africa', 'Asia', 'Oceania',
         'European Union'
     ]))
-    df_table = df[~df['location'].isin(excluded_aggregates)]
+    return df[~df['location'].isin(excluded_aggregates)]
+
+def standard_export(df, output_path, grapher_name, max_workers=4):
+    # Grapher
+    df_grapher = df[GRAPHER_COL_NAMES.keys()].copy()
+    df_grapher['date'] = _to_day_index(df_grapher['date']) - _to_day_index([zero_day])[0]
+    df_grapher = df_grapher.rename(columns=GRAPHER_COL_NAMES)
+
+    # Table & public extracts for external users
+    df_table = standard_table(df)
     # full_data.csv
     full_data_cols = existsin(FULL_DATA_COLS, df_table.columns)
-    df_table[full_data_cols] \
-        .dropna(subset=BASE_MEASURES, how='all') \
-        .to_csv(
-            os.path.join(output_path, 'full_data.csv'),
-            index=False
-        )
-    # Pivot variables (wide format)
-    for col_name in [*BASE_MEASURES, *PER_MILLION_MEASURES]:
-        df_pivot = df_table.pivot(index='date', columns='location', values=col_name)
-        # move World to first column
-        cols = df_pivot.columns.tolist()
-        cols.insert(0, cols.pop(cols.index('World')))
-        df_pivot[cols].to_csv(os.path.join(output_path, '%s.csv' % col_name))
+    df_full_data = df_table[full_data_cols].dropna(subset=BASE_MEASURES, how='all')
+
+    # Pivot variables (wide format), all from a single unstack
+    pivot_cols = [*BASE_MEASURES, *PER_MILLION_MEASURES]
+    df_pivot = df_table.set_index(['date', 'location'])[pivot_cols].unstack('location')
+    # move World to first column
+    locations = df_pivot.columns.get_level_values('location').unique().tolist()
+    locations.insert(0, locations.pop(locations.index('World')))
+
+    # CSV serialization dominates, so the files are written concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(df_grapher.to_csv, os.path.join(output_path, '%s.csv' % grapher_name), index=False),
+            executor.submit(df_full_data.to_csv, os.path.join(output_path, 'full_data.csv'), index=False),
+            *[
+                executor.submit(
+                    df_pivot[col_name][locations].to_csv,
+                    os.path.join(output_path, '%s.csv' % col_name)
+                )
+                for col_name in pivot_cols
+            ]
+        ]
+        for future in futures:
+            future.result()
     return True
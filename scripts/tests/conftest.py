@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../scripts"))
+
+import megafile
+
+
+@pytest.fixture(autouse=True)
+def testing_locations(monkeypatch):
+    # The testing dataset is generated by another pipeline and may be absent
+    monkeypatch.setattr(megafile, "get_testing_locations", lambda: frozenset(["France", "Italy"]))
@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import megafile
+
+
+def _internal_frame():
+    columns = {col for columns in megafile.internal_files_columns.values() for col in columns}
+    df = pd.DataFrame({col: np.nan for col in columns - {"cfr"}}, index=range(3))
+    return df.assign(
+        iso_code="SDN",
+        continent="Africa",
+        location="Sudan",
+        date=["2020-03-12", "2020-03-13", "2020-03-14"],
+        population=43849269.0,
+        total_cases=[0.0, 0.0, 1.0],
+        total_deaths=[0.0, 1.0, 1.0],
+    )
+
+
+def test_create_internal_without_cases(tmp_path, monkeypatch):
+    monkeypatch.setattr(megafile, "DATA_DIR", str(tmp_path))
+    megafile.create_internal(_internal_frame())
+    with open(os.path.join(tmp_path, "internal", "megafile--deaths.json")) as file:
+        deaths = json.load(file)
+    assert deaths["cfr"] == [None, None, 100.0]
+
+
+def test_parquet_row_group_statistics(tmp_path):
+    df = pd.DataFrame({
+        "iso_code": ["AFG", "AFG", "FRA", "ZWE"],
+        "continent": ["Asia", "Asia", "Europe", "Africa"],
+        "location": ["Afghanistan", "Afghanistan", "France", "Zimbabwe"],
+        "date": ["2020-03-01", "2020-03-02", "2020-03-01", "2020-03-01"],
+        "total_cases": [1.0, 2.0, 100.0, np.nan],
+    })
+    output_path = os.path.join(tmp_path, "owid-covid-data.parquet")
+    megafile.df_to_parquet(df, output_path)
+
+    metadata = megafile.pq.ParquetFile(output_path).metadata
+    location_index = metadata.schema.names.index("location")
+    assert metadata.num_row_groups == 3
+    for i, location in enumerate(["Afghanistan", "France", "Zimbabwe"]):
+        statistics = metadata.row_group(i).column(location_index).statistics
+        assert (statistics.min, statistics.max) == (location, location)
+
+
+def _load_source(value):
+    return pd.DataFrame({"value": [value]})
+
+
+def test_source_cache_pruning(tmp_path, monkeypatch):
+    monkeypatch.setattr(megafile, "SOURCE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(megafile, "source_cache_stats", {"hits": [], "misses": []})
+    input_path = tmp_path / "input.csv"
+    input_path.write_text("a")
+    megafile.cached_source("macro_population", _load_source, args=(1,), input_paths=[input_path])
+    megafile.cached_source("macro_population_density", _load_source, args=(2,), input_paths=[input_path])
+    megafile.cached_source("reprod", _load_source, args=(3,), input_paths=[input_path])
+    input_path.write_text("b")
+    megafile.cached_source("macro_population", _load_source, args=(1,), input_paths=[input_path])
+    (tmp_path / "cache" / ".vax-0123456789abcdef.tmp.feather").write_bytes(b"")
+
+    # Only the latest entry of each source is kept
+    entries = sorted(os.listdir(tmp_path / "cache"))
+    assert [megafile._cache_entry_source(entry) for entry in entries] == \
+        [None, "macro_population", "macro_population_density", "reprod"]
+
+    monkeypatch.setattr(megafile, "source_cache_stats", {"hits": [], "misses": []})
+    megafile.cached_source("macro_population", _load_source, args=(1,), input_paths=[input_path])
+    megafile.prune_source_cache()
+    assert megafile.source_cache_stats["hits"] == ["macro_population"]
+    assert [megafile._cache_entry_source(entry) for entry in os.listdir(tmp_path / "cache")] == \
+        ["macro_population"]
+
+
+def test_source_cache_without_inputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(megafile, "SOURCE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(megafile, "source_cache_stats", {"hits": [], "misses": []})
+    # Sources whose inputs are missing are reloaded every time and never stored
+    for _ in range(2):
+        df = megafile.cached_source("vax", _load_source, args=(1,), input_paths=[tmp_path / "missing.csv"])
+        pd.testing.assert_frame_equal(df, _load_source(1))
+    assert megafile.source_cache_stats == {"hits": [], "misses": ["vax", "vax"]}
+    assert not os.path.exists(tmp_path / "cache")
+
+
+REPROD_CSV = b"""Country/Region,Date,R,days_infectious
+Czech Republic,2020-03-01,1.234,7
+Czech Republic,2020-03-01,1.5,5
+Italy,2020-03-01,2.346,7
+"""
+
+
+class _ReprodHandler(BaseHTTPRequestHandler):
+    etag = '"v1"'
+    last_modified = "Sun, 01 Mar 2020 00:00:00 GMT"
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Last-Modified", self.last_modified)
+        self.send_header("Content-Length", str(len(REPROD_CSV)))
+        self.end_headers()
+        self.wfile.write(REPROD_CSV)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def reprod_server():
+    server = HTTPServer(("127.0.0.1", 0), _ReprodHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_reprod_mirror(tmp_path, monkeypatch, reprod_server):
+    monkeypatch.setattr(megafile, "source_cache_stats", {"hits": [], "misses": []})
+    url = f"http://127.0.0.1:{reprod_server.server_port}/database.csv"
+    mirror_dir = tmp_path / "reproduction"
+    mapping_path = tmp_path / "reprod_country_standardized.csv"
+    mapping_path.write_text("reprod,owid\nCzech Republic,Czechia\n")
+    expected = pd.DataFrame({
+        "location": ["Czechia", "Italy"],
+        "date": ["2020-03-01", "2020-03-01"],
+        "reproduction_rate": [1.23, 2.35],
+    })
+
+    # The first fetch writes the mirror
+    reprod = megafile.get_reprod(url, str(mirror_dir), str(mapping_path))
+    pd.testing.assert_frame_equal(reprod, expected)
+    assert sorted(os.listdir(mirror_dir)) == ["reprod.feather", "reprod_mirror.json"]
+    assert "If-None-Match" not in reprod_server.requests[0]
+
+    # The second one is answered with 304 and reads the mirror
+    reprod = megafile.get_reprod(url, str(mirror_dir), str(mapping_path))
+    pd.testing.assert_frame_equal(reprod, expected)
+    assert reprod_server.requests[1]["If-None-Match"] == _ReprodHandler.etag
+    assert reprod_server.requests[1]["If-Modified-Since"] == _ReprodHandler.last_modified
+    assert megafile.source_cache_stats == {"hits": ["reprod"], "misses": ["reprod"]}
+
+    # Without a server, the mirror is used as is
+    reprod_server.shutdown()
+    reprod_server.server_close()
+    reprod = megafile.get_reprod(url, str(mirror_dir), str(mapping_path))
+    pd.testing.assert_frame_equal(reprod, expected)
+    assert len(reprod_server.requests) == 2
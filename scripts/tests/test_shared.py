@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+from shared import get_aggregates_spec, inject_biweekly_growth, inject_cfr, inject_days_since, \
+    inject_derived_columns, inject_doubling_days, inject_exemplars, inject_per_million, \
+    inject_rolling_avg, inject_weekly_growth
+
+# As passed by jhu.py and ecdc.py
+PER_MILLION_MEASURES = [
+    "new_cases",
+    "new_deaths",
+    "total_cases",
+    "total_deaths",
+    "weekly_cases",
+    "weekly_deaths",
+    "biweekly_cases",
+    "biweekly_deaths"
+]
+
+def _zero_total_frame():
+    # Sudan reported a death before its first case was recorded
+    return pd.DataFrame({
+        "date": ["2020-03-12", "2020-03-13", "2020-03-14"],
+        "location": ["Sudan"] * 3,
+        "new_cases": [0.0, 0.0, 1.0],
+        "new_deaths": [0.0, 1.0, 0.0],
+        "total_cases": [0.0, 0.0, 1.0],
+        "total_deaths": [0.0, 1.0, 1.0],
+    })
+
+def _multi_location_frame():
+    # Five weeks of Italy and Sudan, Sudan skipping a week and starting with no cases
+    italy_dates = pd.date_range("2020-03-01", periods=35)
+    sudan_dates = italy_dates[:7].append(italy_dates[14:])
+    df = pd.DataFrame({
+        "date": np.concatenate([italy_dates, sudan_dates]).astype("datetime64[D]").astype(str),
+        "location": ["Italy"] * len(italy_dates) + ["Sudan"] * len(sudan_dates),
+        "new_cases": np.concatenate([np.arange(35) * 150.0, [0, 0, 1, 2, 0, 5, 3] * 4]),
+        "new_deaths": np.concatenate([np.arange(35) * 10.0, [0, 1, 0, 0, 1, 0, 2] * 4]),
+    })
+    df[["total_cases", "total_deaths"]] = df.groupby("location")[["new_cases", "new_deaths"]].cumsum()
+    # Rows are not expected in order
+    return df.sample(frac=1, random_state=0)
+
+
+def test_cfr_is_nan_without_cases():
+    df = inject_cfr(inject_rolling_avg(inject_per_million(_zero_total_frame(), ["new_cases", "new_deaths"])))
+    assert df["cfr"].isna().tolist() == [True, True, False]
+    assert df["cfr"].iloc[2] == 100
+    assert np.isfinite(df["cfr_short_term"].dropna()).all()
+
+
+def test_fused_cfr_is_nan_without_cases():
+    df = inject_derived_columns(_zero_total_frame(), PER_MILLION_MEASURES)
+    assert df["cfr"].isna().tolist() == [True, True, False]
+    assert not np.isinf(df.select_dtypes("number").to_numpy(dtype=float, na_value=np.nan)).any()
+
+
+def test_aggregates_spec_is_not_shared():
+    spec = get_aggregates_spec()
+    spec["World excl. China"]["exclude"].append("India")
+    del spec["World"]
+    spec = get_aggregates_spec()
+    assert spec["World excl. China"]["exclude"] == ["China"]
+    assert "World" in spec
+
+
+def test_fused_matches_reference():
+    df = _multi_location_frame()
+    reference = inject_weekly_growth(df)
+    reference = inject_biweekly_growth(reference)
+    reference = inject_doubling_days(reference)
+    reference = inject_per_million(reference, PER_MILLION_MEASURES)
+    reference = inject_rolling_avg(reference)
+    reference = inject_cfr(reference)
+    reference = inject_days_since(reference)
+    reference = inject_exemplars(reference)
+    reference = reference.sort_values(by=["location", "date"]).reset_index(drop=True)
+    fused = inject_derived_columns(df, PER_MILLION_MEASURES).reset_index(drop=True)
+    pd.testing.assert_frame_equal(fused[reference.columns], reference)